@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+# encoding: utf-8
+# Batch conversion : every .scar archive of a directory is converted and compiled in both formats
+# (<name>-print.pdf and <name>-a4.pdf) by a bounded pool of worker processes.
+# The themes file is parsed once, the preamble formats, artwork and cards caches are shared by every archive
+# (entries used by a running conversion are not evicted by the others, see opale2flashcard.DiskCache).
+# Question images shared by several quizzes of an archive are embedded once in its PDFs.
+# Usage : python3 compile_all.py indir outdir [themefile] [--workers N] [--cache-dir dir] [--work_dir dir]
+import os
+import sys
+import time
+import shutil
+import argparse
+import re
+import traceback
+import multiprocessing
+from lxml import etree
+import opale2flashcard
+
+parser = argparse.ArgumentParser(description = "Converts and compiles every .scar archive of a directory in parallel, in the default and a4paper formats.")
+parser.add_argument('indir', help = """
+Input directory - Directory containing the .scar archives.
+""")
+parser.add_argument('outdir', help = """
+Output directory - Receives <name>-print.pdf and <name>-a4.pdf for every archive <name>.scar.
+""")
+parser.add_argument('themefile', nargs = '?', default = os.path.join(opale2flashcard.script_dir, '..', 'Example-files', 'themeLicence.xml'), help = """
+Themes list file path - Defaults to Example-files/themeLicence.xml.
+""")
+parser.add_argument('--workers', action = 'store', type = int, default = os.cpu_count() or 1, help = """
+Worker processes - Number of archives converted and compiled at the same time. Defaults to the number of CPUs.
+""")
+parser.add_argument('--cache-dir', '--cache_dir', dest = 'cache_dir', action = 'store', default = os.path.join(opale2flashcard.script_dir, 'output', 'cache'), help = """
+Shared cache directory - Parsed flashcards, preamble formats, converted artwork and compiled cards of every archive (see opale2flashcard.py --cache-dir). Defaults to Python/output/cache.
+""")
+parser.add_argument('--work_dir', action = 'store', default = os.path.join(opale2flashcard.script_dir, 'output', 'batch'), help = """
+Work directory - Each archive is converted in its own subdirectory (TeX files, logs, auxiliary files). Defaults to Python/output/batch.
+""")
+
+# PDF of each format, and its name in the output directory
+pdf_names = (('default', '-print.pdf'), ('a4paper', '-a4.pdf'))
+
+def init_worker(themes_key, themes):
+    # The themes parsed by the parent are reused by every conversion of the worker
+    opale2flashcard.parsed_themes[themes_key] = themes
+
+def publish(source, destination):
+    # Readers of the output directory never see a partly written PDF
+    temporary = os.path.join(os.path.dirname(destination), '.' + os.path.basename(destination) + '.' + str(os.getpid()) + '.tmp')
+    shutil.copyfile(source, temporary)
+    os.replace(temporary, destination)
+
+# Error lines of a xelatex log (--file-line-error, or TeX's '! ' messages)
+log_error_regex = re.compile(r'^(?:.*:[0-9]+: .*|! .*)$', re.MULTILINE)
+
+def compile_errors(result, output_dir):
+    # Why a PDF is missing : the compilation messages of the conversion, and the first error of out.log
+    reasons = [message for message in result.logs if 'could not' in message]
+    try:
+        with open(os.path.join(output_dir, 'out.log'), 'r', encoding = 'utf-8', errors = 'replace') as log:
+            error = log_error_regex.search(log.read())
+        if (error is not None):
+            reasons.append('out.log: ' + error.group(0).strip())
+    except OSError:
+        pass
+    return reasons
+
+def compile_archive(task):
+    # Runs in a worker process, returns the summary line of the archive
+    (scarfile, outdir, themefile, work_dir, cache_dir) = task
+    name = os.path.basename(scarfile)[:-len('.scar')]
+    output_dir = os.path.join(work_dir, name)
+    start = time.time()
+    options = {
+        'output_dir' : output_dir,
+        'formats' : 'default,a4paper',
+        'compile' : True,
+        'cache_dir' : cache_dir,
+        'convert_svg' : True,
+        'dedup_images' : True,
+        'precompile_preamble' : True,
+    }
+    try:
+        result = opale2flashcard.convert(scarfile, themefile, options)
+    except opale2flashcard.ConversionError as error:
+        return {'name' : name, 'status' : 'failed', 'error' : str(error), 'seconds' : time.time() - start}
+    except Exception:
+        return {'name' : name, 'status' : 'failed', 'error' : traceback.format_exc().strip().splitlines()[-1], 'seconds' : time.time() - start}
+
+    missing = []
+    reasons = []
+    for (output_format, suffix) in pdf_names:
+        pdf_path = os.path.join(output_dir, output_format, 'out.pdf')
+        if (os.path.isfile(pdf_path)):
+            publish(pdf_path, os.path.join(outdir, name + suffix))
+        else:
+            missing.append(name + suffix)
+            for reason in compile_errors(result, os.path.join(output_dir, output_format)):
+                if (reason not in reasons):
+                    reasons.append(reason)
+    return {
+        'name' : name,
+        'status' : 'done' if len(missing) == 0 else 'no pdf',
+        'error' : ('not compiled : ' + ', '.join(missing) + ''.join(' ; ' + reason for reason in reasons)) if len(missing) > 0 else '',
+        'accepted' : sum(result.accepted.values()),
+        'rejected' : sum(result.rejected.values()),
+        'seconds' : time.time() - start,
+    }
+
+def print_summary(results, elapsed):
+    print('\n{0:<40} {1:<8} {2:>8} {3:>8} {4:>9}'.format('archive', 'status', 'accepted', 'rejected', 'seconds'))
+    for result in sorted(results, key = lambda result: result['name']):
+        print('{0:<40} {1:<8} {2:>8} {3:>8} {4:>9.1f}  {5}'.format(result['name'], result['status'], result.get('accepted', '-'), result.get('rejected', '-'), result['seconds'], result['error']))
+    failed = sum(1 for result in results if result['status'] != 'done')
+    print('{0} archives, {1} failed, {2:.1f} s ({3:.1f} s of conversions)'.format(len(results), failed, elapsed, sum(result['seconds'] for result in results)))
+    return failed
+
+def main():
+    args = parser.parse_args()
+    if (not os.path.isdir(args.indir)):
+        sys.stderr.write("Input dir '" + args.indir + "' is not a directory\n")
+        sys.exit(1)
+    if (not os.path.isdir(args.outdir)):
+        sys.stderr.write("Output dir '" + args.outdir + "' is not a directory\n")
+        sys.exit(1)
+    if (not os.path.isfile(args.themefile)):
+        sys.stderr.write('Error themefile: ' + args.themefile + ' is not a file or does not exist.\n')
+        sys.exit(1)
+    scarfiles = sorted(os.path.join(args.indir, file) for file in os.listdir(args.indir) if file.endswith('.scar'))
+    if (len(scarfiles) == 0):
+        print('compile_all.py: no .scar archive in ' + args.indir)
+        return
+
+    # Parsed once here, instead of once per archive
+    themefile = os.path.abspath(args.themefile)
+    themes = opale2flashcard.get_subject_and_themes(themefile, etree.XMLParser(remove_blank_text=True, remove_comments=True))
+    themes_key = opale2flashcard.file_hash(themefile)
+
+    tasks = [(os.path.abspath(scarfile), os.path.abspath(args.outdir), themefile, os.path.abspath(args.work_dir), os.path.abspath(args.cache_dir)) for scarfile in scarfiles]
+    start = time.time()
+    results = []
+    pool = multiprocessing.Pool(processes = max(1, min(args.workers, len(tasks))), initializer = init_worker, initargs = (themes_key, themes))
+    try:
+        # Largest archives first, a long conversion does not end the batch alone
+        tasks.sort(key = lambda task: os.path.getsize(task[0]), reverse = True)
+        for result in pool.imap_unordered(compile_archive, tasks):
+            print('compile_all.py: {0} {1} ({2:.1f} s)'.format(result['name'], result['status'], result['seconds']))
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+    if (print_summary(results, time.time() - start) > 0):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
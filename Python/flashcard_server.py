@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+# encoding: utf-8
+# Conversion service for the web front end : opale2flashcard stays loaded in a few worker
+# processes (imports, parsed themes, caches), and uploads are queued instead of all running at once.
+#   POST /jobs?a4paper=1&compile=1   body : the .scar archive   -> 202 {"id" : ...}, 503 if the queue is full
+#   GET /jobs/<id>                                              -> {"status" : "queued" | "running" | "done" | "failed", ...}
+# Re-uploads of an archive with the same options get the previous latex.zip and out.pdf right away.
+# Usage : python3 flashcard_server.py themefile [--port 8765] [--workers 2] [--queue_size 8] [--jobs_dir /tmp/flashcard-jobs]
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import threading
+import shutil
+import multiprocessing
+import zipfile
+import hashlib
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import opale2flashcard
+
+parser = argparse.ArgumentParser(description = "Queues .scar conversions sent over HTTP and runs them in resident opale2flashcard worker processes.")
+parser.add_argument('themefile', help = """
+Themes list file path - Used for every job.
+""")
+parser.add_argument('--host', action = 'store', default = '127.0.0.1', help = """
+Listening address - Defaults to 127.0.0.1, the service is not meant to be exposed.
+""")
+parser.add_argument('--port', action = 'store', type = int, default = 8765, help = """
+Listening port - Defaults to 8765.
+""")
+parser.add_argument('--workers', action = 'store', type = int, default = 2, help = """
+Worker processes - Number of conversions (and compilations) running at the same time. Defaults to 2.
+""")
+parser.add_argument('--queue_size', action = 'store', type = int, default = 8, help = """
+Queue size - Number of jobs waiting for a worker. Further uploads are refused (HTTP 503) until a job ends. Defaults to 8.
+""")
+parser.add_argument('--jobs_dir', action = 'store', default = '/tmp/flashcard-jobs', help = """
+Jobs directory - Each job gets its own directory : scenari.scar, output/, latex.zip.
+""")
+parser.add_argument('--keep_jobs', action = 'store', type = int, default = 1000, help = """
+Finished jobs kept - Status and directory of the last N finished jobs, older ones are removed and can no longer be polled. Defaults to 1000.
+""")
+parser.add_argument('--max_size', action = 'store', type = int, default = 262144000, help = """
+Maximum upload size in bytes - Defaults to 250 MB, as the web front end.
+""")
+parser.add_argument('--result_cache_size', action = 'store', type = int, default = 1024, help = """
+Results cache size - Maximum size in MB of the previous jobs' latex.zip and out.pdf, kept in [cache-dir or jobs_dir]/results. Least recently used results are removed first. 0 disables it. Defaults to 1024.
+""")
+parser.add_argument('--cache-dir', '--cache_dir', dest = 'cache_dir', action = 'store', help = """
+Shared cache directory - Passed to every job (see opale2flashcard.py --cache-dir), with --convert_svg and --precompile_preamble.
+""")
+
+# Options a client may set for its job, anything else is ignored
+job_options = ('a4paper', 'compile', 'force', 'add_complexity_level', 'no_replace', 'add_qrcode')
+
+def read_job_options(query):
+    options = {}
+    for (name, values) in parse_qs(query).items():
+        if (name not in job_options):
+            continue
+        if (name == 'add_qrcode'):
+            options[name] = values[-1]
+        else:
+            options[name] = values[-1] not in ('', '0', 'false')
+    return options
+
+class ResultCache:
+    # latex.zip, out.pdf and status of finished jobs, keyed by the archive, the options and
+    # everything else the result depends on : themes, converter, headers, footer and images
+    # (read when the service starts). The status entry is written last, a result is complete once it exists.
+    def __init__(self, directory, max_size, themefile):
+        self.disk_cache = opale2flashcard.DiskCache(directory, max_size)
+        script_dir = opale2flashcard.script_dir
+        sha = hashlib.sha256()
+        for path in (opale2flashcard.__file__, themefile, os.path.join(script_dir, 'header_default.tex'), os.path.join(script_dir, 'header_a4paper.tex'), os.path.join(script_dir, 'footer.tex')):
+            sha.update(opale2flashcard.file_hash(path).encode('utf-8'))
+        sha.update(opale2flashcard.get_images_fingerprint(os.path.join(script_dir, 'output', 'images')).encode('utf-8'))
+        self.run_key = sha.hexdigest()
+
+    def key(self, archive, options):
+        sha = hashlib.sha256((self.run_key + '\n' + json.dumps(options, sort_keys = True) + '\n').encode('utf-8'))
+        sha.update(archive)
+        return sha.hexdigest()
+
+    def load(self, key, job_dir):
+        # Copies a previous result in job_dir, returns its status or None
+        data = self.disk_cache.get(key + '.json')
+        if (data is None):
+            return None
+        status = json.loads(data.decode('utf-8'))
+        for (name, entry) in (('zip', 'latex.zip'), ('pdf', 'out.pdf')):
+            if (status[name] is None):
+                continue
+            data = self.disk_cache.get(key + '.' + name)
+            # Partly evicted
+            if (data is None):
+                return None
+            with open(os.path.join(job_dir, entry), 'wb') as result_file:
+                result_file.write(data)
+            status[name] = os.path.join(job_dir, entry)
+        status['cached'] = True
+        return status
+
+    def store(self, key, status):
+        for name in ('zip', 'pdf'):
+            if (status[name] is not None):
+                with open(status[name], 'rb') as result_file:
+                    self.disk_cache.put(key + '.' + name, result_file.read())
+        self.disk_cache.put(key + '.json', json.dumps(status).encode('utf-8'))
+
+def run_job(job_dir, themefile, options, result_cache, result_key):
+    # Runs in a worker process : opale2flashcard and the parsed themes stay loaded between jobs
+    output_dir = os.path.join(job_dir, 'output')
+    options = dict(options, output_dir = output_dir)
+    try:
+        result = opale2flashcard.convert(os.path.join(job_dir, 'scenari.scar'), themefile, options)
+    except opale2flashcard.ConversionError as error:
+        return {'status' : 'failed', 'error' : str(error)}
+
+    # Every output file, as the web front end serves them : the image paths of out.tex are relative
+    # to the output directory, which compiles once extracted anywhere else
+    zip_path = os.path.join(job_dir, 'latex.zip')
+    with zipfile.ZipFile(zip_path + '.tmp', 'w', zipfile.ZIP_DEFLATED) as archive:
+        # The shared images are only linked in the job's workspace, their content is archived
+        for (root_dir, dirs, files) in os.walk(output_dir, followlinks = True):
+            dirs.sort()
+            for file in sorted(files):
+                archive.write(os.path.join(root_dir, file), os.path.relpath(os.path.join(root_dir, file), output_dir))
+    os.replace(zip_path + '.tmp', zip_path)
+    pdf_path = os.path.join(output_dir, 'out.pdf')
+    status = {
+        'status' : 'done',
+        'accepted' : result.accepted,
+        'rejected' : result.rejected,
+        'question_count' : result.question_count,
+        'err_count' : result.err_count,
+        'logs' : result.logs,
+        'zip' : zip_path,
+        'pdf' : pdf_path if os.path.isfile(pdf_path) else None,
+    }
+    # A failed compilation may not fail the next time
+    if (result_cache is not None and (options.get('compile', False) is False or status['pdf'] is not None)):
+        result_cache.store(result_key, status)
+    return status
+
+class JobQueue:
+    # Jobs waiting for, or run by, a pool of worker processes.
+    # At most workers + queue_size jobs are accepted at the same time.
+    def __init__(self, themefile, workers, queue_size, jobs_dir, keep_jobs, shared_options, result_cache):
+        self.themefile = os.path.abspath(themefile)
+        self.result_cache = result_cache
+        self.jobs_dir = jobs_dir
+        self.keep_jobs = keep_jobs
+        self.shared_options = shared_options
+        self.jobs = OrderedDict()
+        self.finished = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        os.makedirs(self.jobs_dir, exist_ok = True)
+        # Workers are forked once, with opale2flashcard already imported
+        self.pool = multiprocessing.Pool(processes = workers)
+
+    def submit(self, archive, options):
+        # Returns the job id, None if the queue is full
+        options = dict(options, **self.shared_options)
+        job_id = os.urandom(16).hex()
+        job_dir = os.path.join(self.jobs_dir, job_id)
+
+        # Same archive and options as a previous job : done right away, without a worker
+        result_key = None
+        if (self.result_cache is not None):
+            result_key = self.result_cache.key(archive, options)
+            os.makedirs(job_dir)
+            status = self.result_cache.load(result_key, job_dir)
+            if (status is not None):
+                status['submitted'] = status['finished'] = time.time()
+                with self.lock:
+                    self.jobs[job_id] = status
+                    forgotten = self.forget(job_id)
+                self.remove(forgotten)
+                return job_id
+            os.rmdir(job_dir)
+
+        if (self.slots.acquire(blocking = False) is False):
+            return None
+        os.makedirs(job_dir)
+        with open(os.path.join(job_dir, 'scenari.scar'), 'wb') as scar:
+            scar.write(archive)
+        with self.lock:
+            self.jobs[job_id] = {'status' : 'queued', 'submitted' : time.time()}
+        self.pool.apply_async(
+            run_job, (job_dir, self.themefile, options, self.result_cache, result_key),
+            callback = lambda result: self.finish(job_id, result),
+            error_callback = lambda error: self.finish(job_id, {'status' : 'failed', 'error' : repr(error)})
+        )
+        return job_id
+
+    def finish(self, job_id, result):
+        with self.lock:
+            result['submitted'] = self.jobs[job_id]['submitted']
+            result['finished'] = time.time()
+            self.jobs[job_id] = result
+            forgotten = self.forget(job_id)
+        self.remove(forgotten)
+        self.slots.release()
+
+    def forget(self, job_id):
+        # Called with the lock held when a job is finished : forgets the oldest finished jobs,
+        # whose ids are returned to remove their directories (see remove)
+        self.finished.append(job_id)
+        forgotten = []
+        while (len(self.finished) > self.keep_jobs):
+            forgotten.append(self.finished.pop(0))
+            self.jobs.pop(forgotten[-1], None)
+        return forgotten
+
+    def remove(self, job_ids):
+        # Directories of forgotten jobs, removed without the lock held : the result cache keeps its own copies
+        for job_id in job_ids:
+            shutil.rmtree(os.path.join(self.jobs_dir, job_id), ignore_errors = True)
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id, None)
+            if (job is None):
+                return None
+            job = dict(job)
+        # Queued jobs do not know when a worker picks them up, the output directory tells
+        if (job['status'] == 'queued' and os.path.isdir(os.path.join(self.jobs_dir, job_id, 'output'))):
+            job['status'] = 'running'
+        job['id'] = job_id
+        return job
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    # The JobQueue is set on the server
+    def send_json(self, code, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if (url.path != '/jobs'):
+            self.send_json(404, {'error' : 'not found'})
+            return
+        size = int(self.headers.get('Content-Length', 0))
+        if (size <= 0 or size > self.server.max_size):
+            self.send_json(413, {'error' : 'the archive is empty or too large'})
+            return
+        archive = self.rfile.read(size)
+        if (not zipfile.is_zipfile(io.BytesIO(archive))):
+            self.send_json(400, {'error' : 'not a .scar archive'})
+            return
+        job_id = self.server.job_queue.submit(archive, read_job_options(url.query))
+        if (job_id is None):
+            self.send_json(503, {'error' : 'too many jobs, retry later'})
+            return
+        self.send_json(202, {'id' : job_id})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if (not url.path.startswith('/jobs/')):
+            self.send_json(404, {'error' : 'not found'})
+            return
+        job = self.server.job_queue.status(url.path[len('/jobs/'):])
+        if (job is None):
+            self.send_json(404, {'error' : 'unknown job'})
+            return
+        self.send_json(200, job)
+
+def main():
+    args = parser.parse_args()
+    if (not os.path.isfile(args.themefile)):
+        sys.stderr.write('Error themefile: ' + args.themefile + ' is not a file or does not exist.\n')
+        sys.exit(1)
+    shared_options = {}
+    if (args.cache_dir is not None):
+        shared_options = {'cache_dir' : os.path.abspath(args.cache_dir), 'convert_svg' : True, 'precompile_preamble' : True}
+    result_cache = None
+    if (args.result_cache_size > 0):
+        result_cache = ResultCache(os.path.join(args.cache_dir or args.jobs_dir, 'results'), args.result_cache_size * 1024 * 1024, args.themefile)
+    job_queue = JobQueue(args.themefile, args.workers, args.queue_size, args.jobs_dir, args.keep_jobs, shared_options, result_cache)
+    server = ThreadingHTTPServer((args.host, args.port), JobRequestHandler)
+    server.job_queue = job_queue
+    server.max_size = args.max_size
+    print('flashcard_server.py: listening on http://' + args.host + ':' + str(args.port) + ', ' + str(args.workers) + ' workers')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        job_queue.pool.terminate()
+
+if __name__ == '__main__':
+    main()
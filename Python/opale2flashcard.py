@@ -15,6 +15,20 @@ import timeit
 from lxml import etree
 from itertools import zip_longest
 import qrcode
+import multiprocessing
+import multiprocessing.pool
+import json
+import hashlib
+import pickle
+import copy
+import zipfile
+import io
+import subprocess
+import tempfile
+import sqlite3
+import contextlib
+import cProfile
+import threading
 
 parser = argparse.ArgumentParser(description="""
 === Conversion from mcqMur/mcqSur (Opale-XML) to LaTeX (flashcard class) ===
@@ -51,6 +65,7 @@ There are two output formats :
     Every page contains 6 flashcards (10x8 cm).
     A grid outlines the borders. 
     This is the preferred format for printing at home.
+Both can be written by a single run, from a single parse, with '--formats default,a4paper'.
 Some options can be used to filter the output (image_only, overflow_only, file_name [file_name])
 Combining these options will join the results, duplicates might exist.
 Using these options can help greatly in checking whether a flashcard is correctly transcripted.
@@ -77,20 +92,25 @@ Below, we define which content is supported or not.
 Some options are available to help debug the code and/or check if the output
 is correct. 
 Logs will be in './output/logs.txt'.
+With '--store flashcards.db', the parsed flashcards are recorded in an SQLite database.
+Adding '--from_store' then selects them from the database instead of parsing the source again.
+'--inventory' only counts the .quiz files by subject, theme, level and question type, reading their metadata.
+'--profile' times every stage and every .quiz file, '--cprofile run.prof' dumps cProfile statistics.
 
 --- How to use ---
-After cloning the repository, you should download a .scar archive from Scenari
-and unzip it directly in the same directory (rename it to '*.zip').
-Pass in the path to the directory containing the .quiz files to the script.
+After cloning the repository, you should download a .scar archive from Scenari.
+Pass in the path to the archive to the script, or unzip it (rename it to '*.zip')
+and pass in the path to the directory containing the .quiz files.
 If you have xelatex installed, you can use the '--compile' option to directly
 compile the pdf. 
 """, formatter_class=RawDescriptionHelpFormatter)
 
 parser.add_argument('sourcedir', help = """
-XML files\' directory path - Path to root directory containing all XML files. 
-N.B. : Unzipping a .scar archive is the simplest workaround to have the .quiz files locally. 
+XML files\' directory path - Path to root directory containing all XML files, or path to a .scar (.zip) archive. 
+Archives are read directly, only the images used by the flashcards are extracted (in output/resources).
 To refer correctly to the "000&" directory, you need to add an \ before. The path becomes "*/\&.
 Example : python3 opale2flashcard.py faq2sciences/Physique-thermo_2020-2-11/\&
+Example : python3 opale2flashcard.py faq2sciences/Physique-thermo_2020-2-11.scar
 """)
 parser.add_argument('themefile', help = """
 Themes list file path - Path to an xml file containing all theme codes.
@@ -98,9 +118,15 @@ Themes list file path - Path to an xml file containing all theme codes.
 parser.add_argument('--a4paper', action = 'store_true', help  ="""
 Output format - defaults to printing 10x8cm flashcards. If activated, will output flashcard on an a4paper.
 """)
+parser.add_argument('--formats', action = 'store', help = """
+Several output formats - Comma-separated list of formats among default and a4paper, e.g. 'default,a4paper'. The quizzes are parsed and checked once, and every format is written in its own subdirectory of the output directory (output/default, output/a4paper). Replaces '--a4paper'. Combined with '--compile' and '--compile-jobs' N > 1, the formats are compiled at the same time.
+""")
 parser.add_argument('--output', action = 'store', help = """
 Custom folder path - Outputs in subdirectory given as parameter. Pass only one name. Will create /cap_flashcards/Python/output/subdirectory
 """)
+parser.add_argument('--output_dir', action = 'store', help = """
+Output directory path - Outputs in the given directory instead of /cap_flashcards/Python/output. The directory is a self-contained workspace (TeX files, logs, QR code, images linked from Python/output/images, auxiliary files), so that concurrent runs do not collide.
+""")
 parser.add_argument('--noclean', action = 'store_true', help  ="""
 Clean output folder - Cleanse by default
 """)
@@ -131,6 +157,24 @@ Debugging tool - Outputs only files with potential overflowing content.
 parser.add_argument('--non_relevant_only', action = 'store_true', help = """
 Debugging tool - Outputs only files with content flagged non-relevant.
 """)
+parser.add_argument('--inventory', action = 'store', nargs = '?', const = '', metavar = 'JSON_FILE', help = """
+Inventory - Only counts the .quiz files by question type, subject, theme, complexity and education level, and the missing metadata. Each file is read up to its question, nothing is written in the output directory. The counts are also written in JSON_FILE if given.
+""")
+parser.add_argument('--profile', action = 'store', nargs = '?', const = '', metavar = 'JSON_FILE', help = """
+Profiling - Measures the wall and CPU time of every stage (themes, resource index, parsing, rendering, artwork, compilation and xelatex passes) and of every .quiz file (reading, fetching, texfilter, image probing, checks). Prints the stages and the slowest files, and writes a JSON report in JSON_FILE (defaults to output/profile.json).
+""")
+parser.add_argument('--profile_top', action = 'store', type = int, default = 10, help = """
+Profiling - Number of slowest .quiz files printed by '--profile'. Defaults to 10.
+""")
+parser.add_argument('--cprofile', action = 'store', metavar = 'PROF_FILE', help = """
+Profiling - Runs the conversion under cProfile and dumps the statistics in PROF_FILE (see python3 -m pstats). Parsing workers are not profiled, use '--jobs 1'.
+""")
+parser.add_argument('--store', action = 'store', help = """
+Parsed flashcards store - Path to an SQLite database. Every run parsing the whole source (without '--file_name') records its parsed flashcards there, with their flags and messages, replacing the previous records of the source parsed with the same options.
+""")
+parser.add_argument('--from_store', action = 'store_true', help = """
+Debugging tool - Combined with '--store', reads the flashcards recorded for the source instead of parsing the .quiz files. '--file_name', '--image_only', '--overflow_only' and '--non_relevant_only' are then answered by the database, the source tree is neither walked nor parsed. Only the messages of the selected flashcards are written.
+""")
 parser.add_argument('--no_replace', action = 'store_true', help = """
 Question with image - Stops replacing "ci-dessous" with "ci-contre" for files with images in the question.  
 """)
@@ -143,6 +187,48 @@ Generates a qrcode - Generating a qrcode from the url passed as an argument
 parser.add_argument('--add_complexity_level', action = 'store_true', help = """
 Add the complexity level - Adds the complexity level to the flashcard. By default, does not display.
 """)
+parser.add_argument('--texfilter_table', action = 'store', help = """
+Custom substitutions - Path to a JSON file mapping characters (or strings) to their LaTeX replacement, e.g. {"ℓ" : "$\\\\ell$"}. Extends the default table (greek letters, arrows).
+""")
+parser.add_argument('--cache-dir', '--cache_dir', dest = 'cache_dir', action = 'store', help = """
+Incremental rebuilds - Caches every parsed flashcard and its TeX output in the given directory, keyed by the .quiz file content, the themes file and the output options. Only changed files are parsed again. Ignored with '--debug_mode'. The sizes of the images are kept too, whatever the options.
+""")
+parser.add_argument('--cache_size', action = 'store', type = int, default = 512, help = """
+Cache size - Maximum size of the cache directory in MB, shared between its caches (flashcards, card PDFs, images, preamble formats, artwork, image sizes). Least recently used entries are removed first. Defaults to 512.
+""")
+parser.add_argument('--jobs', action = 'store', type = int, default = 1, help = """
+Parallel parsing - Parses the .quiz files using N processes. The output is identical to the one of a serial run. Ignored with '--debug_mode'.
+""")
+parser.add_argument('--compile-jobs', '--compile_jobs', dest = 'compile_jobs', action = 'store', type = int, default = 1, help = """
+Parallel compilation - Combined with '--compile', splits out.tex in N documents on card boundaries (page boundaries with '--a4paper'), compiles them in parallel and merges the PDFs in out.pdf with pdfunite or qpdf.
+""")
+parser.add_argument('--compile_cards', action = 'store_true', help = """
+Per-card compilation - Combined with '--compile', compiles every card (every page with '--a4paper') in its own document, '--compile-jobs' at a time. The PDFs are kept in the cache directory ('--cache-dir') or in output/card-cache, unchanged cards are not compiled again. out.pdf and out-[subject].pdf are assembled from them with pdfunite or qpdf.
+""")
+parser.add_argument('--precompile_preamble', action = 'store_true', help = """
+Faster compilation - Combined with '--compile', dumps the header's preamble (packages, macros) in a xelatex format file once, then loads it at every compilation. Formats are kept in the cache directory ('--cache-dir') or in output/formats. Requires the mylatexformat package, falls back to a normal compilation otherwise.
+""")
+parser.add_argument('--convert_svg', action = 'store_true', help = """
+Artwork conversion - Converts the SVG artwork of the headers (backgrounds, icons, logo) to PDF once with rsvg-convert, inkscape or cairosvg, and includes the PDFs. Conversions are kept in the cache directory ('--cache-dir') or in output/artwork-cache. The compilation no longer needs inkscape nor --shell-escape.
+""")
+parser.add_argument('--image_dpi', action = 'store', type = int, help = """
+Print resolution images - Resamples the question images larger than the image slot of a card (3.5 x 3.2 cm) to DPI pixels per inch, and converts the .gif images to PNG instead of ignoring them. Uses '--jobs' processes. Resampled images are kept in the cache directory ('--cache-dir') or in output/image-cache. By default, images are included as they are.
+""")
+parser.add_argument('--duplicates', action = 'store', choices = ('flag', 'drop'), help = """
+Near-duplicate questions - Finds the flashcards whose question, choices and solutions are near-duplicates of another one (MinHash and LSH), keeps the first one and either flags the others as errors ('flag', written to the rejected flashcards even with --force) or does not write them ('drop'). The clusters found are written to duplicates.json in the output directory.
+""")
+parser.add_argument('--duplicate_threshold', action = 'store', type = float, default = 0.8, help = """
+Near-duplicate threshold - Share of common word 3-grams (Jaccard similarity) from which two flashcards are near-duplicates. Defaults to 0.8.
+""")
+parser.add_argument('--dedup_images', action = 'store_true', help = """
+Shared images - Copies every question image in output/image-store under the hash of its content (hard link where possible), and includes the copy : an image referenced by several quizzes under different paths is embedded once in the PDF.
+""")
+# Options of the current run, set by the command line or by convert()
+args = None
+
+# Directory of the script : headers, footer, images and default output directory
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
 # XML namespaces
 namespace = {
     "sm" : "http://www.utc.fr/ics/scenari/v3/modeling",
@@ -177,6 +263,59 @@ tags_markup = {
     "phrase" : ("\href{", "}"),
 }
 
+# Unicode characters replaced by texfilter
+texfilter_table = {
+    'α' : '$\\alpha$',
+    'Α' : '$\\Alpha$',
+    'β' : '$\\beta$',
+    'Β' : '$\\Beta$',
+    'γ' : '$\\gamma$',
+    'Γ' : '$\\Gamma$',
+    'δ' : '$\\delta$',
+    'Δ' : '$\\Delta$',
+    'ε' : '$\\epsilon$',
+    'Ε' : '$\\Epsilon$',
+    'ζ' : '$\\zeta$',
+    'Ζ' : '$\\Zeta$',
+    'η' : '$\\eta$',
+    'Η' : '$\\Eta$',
+    'θ' : '$\\theta$',
+    'Θ' : '$\\Theta$',
+    'ι' : '$\\iota$',
+    'Ι' : '$\\Iota$',
+    'κ' : '$\\kappa$',
+    'Κ' : '$\\Kappa$',
+    'λ' : '$\\lambda$',
+    'Λ' : '$\\Lambda$',
+    'μ' : '$\\mu$',
+    'Μ' : '$\\Mu$',
+    'ν' : '$\\nu$',
+    'Ν' : '$\\Nu$',
+    'ξ' : '$\\xi$',
+    'Ξ' : '$\\Xi$',
+    'ο' : 'o',
+    'Ο' : 'O',
+    'π' : '$\\pi$',
+    'Π' : '$\\Pi$',
+    'ρ' : '$\\rho$',
+    'Ρ' : '$\\Rho$',
+    'σ' : '$\\sigma$',
+    'Σ' : '$\\Sigma$',
+    'τ' : '$\\tau$',
+    'Τ' : '$\\Tau$',
+    'υ' : '$\\upsilon$',
+    'Υ' : '$\\Upsilon$',
+    'φ' : '$\\phi$',
+    'Φ' : '$\\Phi$',
+    'χ' : '$\\chi$',
+    'Χ' : '$\\Chi$',
+    'ψ' : '$\\psi$',
+    'Ψ' : '$\\Psi$',
+    'ω' : '$\\omega$',
+    'Ω' : '$\\Omega$',
+    '→' : '$\\longrightarrow$',
+}
+
 url_regex = re.compile(
         r'^(?:http|ftp)s?://' # http:// or https://
         r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|' #domain...
@@ -187,6 +326,10 @@ url_regex = re.compile(
 
 class Flashcard:
     def __init__(self, file, question_type, complexity_level, subject, education_level, licence_theme, question, image, image_square, image_rectangular, choices, answer, solution_list, choice_number,subject_length, licence_theme_length, question_length, choices_length, answer_length):
+        self.cache_key = None
+        self.resources = []
+        self.references = []
+        self.duplicate_of = None
         self.file = file
         self.question_type = question_type
         self.complexity_level = complexity_level
@@ -211,16 +354,798 @@ class Flashcard:
         self.choices_length = choices_length
         self.answer_length = answer_length
 
+class ResourceIndex:
+    # Index of every resource found in the source directory.
+    # It is built once per run and shared by every flashcard, instead of walking
+    # the whole source tree for each image.
+    # Resources are indexed by their Scenari path (relative to sourcedir, and
+    # relative to the "&" directory) and by basename.
+    # The .quiz files are listed during the same walk.
+    def __init__(self, sourcedir):
+        self.sourcedir = os.path.abspath(sourcedir)
+        self.by_path = {}
+        self.by_name = {}
+        self.quiz_paths = []
+        for (root_dir, dirs, files) in os.walk(self.sourcedir):
+            for name in files:
+                path = os.path.abspath(os.path.join(root_dir, name))
+                self.add(os.path.relpath(path, self.sourcedir).replace(os.sep, '/'), path)
+                if (name.endswith(".quiz")):
+                    self.quiz_paths.append((os.path.join(os.path.relpath(root_dir), name), name))
+
+    def add(self, relpath, location):
+        self.by_path[relpath] = location
+        # Scenari paths start at the "&" directory, which may not be the root
+        if ('/&/' in relpath):
+            self.by_path.setdefault(relpath[relpath.index('/&/') + 1:], location)
+        name = relpath.split('/')[-1]
+        if (name in self.by_name):
+            self.by_name[name].append(location)
+        else:
+            self.by_name[name] = [location]
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def ambiguous_names(self):
+        return {name : locations for (name, locations) in self.by_name.items() if len(locations) > 1}
+
+    def cache_key(self):
+        # Where resources are found, i.e. what the image paths written in out.tex depend on
+        return self.sourcedir
+
+    def source_id(self):
+        # Source of the flashcards recorded in a FlashcardStore
+        return self.sourcedir
+
+    def quiz_files(self, file_name = None):
+        # (workpath, file) for every .quiz file, in os.walk order
+        # workpath is None if the file does not exist anymore (e.g. broken link)
+        quiz_files = []
+        for (workpath, file) in self.quiz_paths:
+            if (file_name is not None and file != file_name):
+                continue
+            if (os.path.isfile(workpath)):
+                quiz_files.append((workpath, file))
+            else:
+                quiz_files.append((None, file))
+        return quiz_files
+
+    def read_quiz(self, workpath):
+        with open(workpath, 'rb') as quiz:
+            return quiz.read()
+
+    def parse_quiz(self, workpath, parser):
+        return etree.parse(workpath, parser)
+
+    def open_quiz(self, workpath):
+        return open(workpath, 'rb')
+
+    def find(self, ref_uri):
+        # Location of a Scenari path (None if not found), and every resource of the same name
+        # when it is found by its basename only
+        # sourcedir can either be the archive root or the "&" directory itself
+        candidates = [ref_uri.lstrip('/')]
+        if (ref_uri.startswith('&/')):
+            candidates.append(ref_uri[2:])
+        for candidate in candidates:
+            if (candidate in self.by_path):
+                return (self.by_path[candidate], None)
+
+        # Fallback on basename
+        locations = self.by_name.get(ref_uri.split("/")[-1], None)
+        if (locations is None):
+            return (None, None)
+        return (locations[-1], locations)
+
+    def locate(self, file, ref_uri):
+        # Scenari path, e.g. "&/Questions/Chimie/image20.png"
+        (location, locations) = self.find(ref_uri)
+        if (locations is None and location is not None):
+            return location
+        name = ref_uri.split("/")[-1]
+        if (locations is None):
+            write_logs(
+                'opale2flashcard.py(' + file + '): WARNING ! Resource not found: ' + ref_uri,
+                'opale2flashcard.py(' + file + '): WARNING ! Resource not found in ' + self.sourcedir + ': ' + ref_uri
+            )
+            return None
+        if (len(locations) > 1):
+            # Keep the last match (os.walk order), but report it
+            write_logs(
+                'opale2flashcard.py(' + file + '): WARNING ! Ambiguous resource name ' + name + ' (' + str(len(locations)) + ' files). Took ' + locations[-1],
+                'opale2flashcard.py(' + file + '): WARNING ! Ambiguous resource name ' + name + ' for ' + ref_uri + '. Candidates:\n\t- ' + '\n\t- '.join(locations) + '\nTook ' + locations[-1]
+            )
+        return locations[-1]
+
+    def resolve(self, location):
+        # Local path of a located resource
+        return location
+
+    def open_resource(self, location):
+        return open(location, 'rb')
+
+    def resource_stamp(self, location):
+        # Changes whenever the resource does
+        stat = os.stat(location)
+        return str(stat.st_mtime_ns) + ' ' + str(stat.st_size)
+
+    def reference_stamps(self, references):
+        # Location and stamp of every referenced Scenari path : a flashcard parsed with other ones
+        # has other images, image layout or messages
+        stamps = []
+        for ref_uri in references:
+            (location, locations) = self.find(ref_uri)
+            try:
+                stamp = self.resource_stamp(location) if location is not None else None
+            except (OSError, KeyError):
+                stamp = None
+            stamps.append((ref_uri, location, tuple(locations) if locations is not None else None, stamp))
+        return stamps
+
+    def image_locations(self):
+        locations = []
+        for (name, name_locations) in self.by_name.items():
+            if (os.path.splitext(name)[1].lower() in image_extensions):
+                locations += name_locations
+        return locations
+
+    def lookup(self, file, ref_uri):
+        location = self.locate(file, ref_uri)
+        if (location is None):
+            return None
+        return self.resolve(location)
+
+class ArchiveResourceIndex(ResourceIndex):
+    # Same index, for a .scar/.zip archive read directly without unzipping it.
+    # The .quiz files are parsed from the archive stream, and the resources are
+    # only extracted (into extract_dir) when a flashcard references them.
+    # Locations are archive member names.
+    def __init__(self, archive_path, extract_dir, archive_data = None):
+        # archive_data : the archive itself, read from memory instead of archive_path
+        self.archive_data = archive_data
+        if (archive_data is not None):
+            self.sourcedir = 'sha256:' + file_hash(archive_data)
+            self.content_hash = self.sourcedir
+        else:
+            self.sourcedir = os.path.abspath(archive_path)
+            self.content_hash = 'sha256:' + file_hash(self.sourcedir)
+        self.extract_dir = os.path.abspath(extract_dir)
+        self.by_path = {}
+        self.by_name = {}
+        self.quiz_paths = []
+        self.zipfile = None
+        self.zipfile_pid = None
+        for member in self.archive().infolist():
+            if (member.is_dir()):
+                continue
+            self.add(member.filename.lstrip('/'), member.filename)
+            name = member.filename.split('/')[-1]
+            if (name.endswith(".quiz")):
+                self.quiz_paths.append((member.filename, name))
+
+    def __getstate__(self):
+        # Zip handles cannot be sent to parsing workers, each process opens its own
+        state = dict(self.__dict__)
+        state['zipfile'] = None
+        return state
+
+    def archive(self):
+        # Forked workers must not share the parent's file offset either
+        if (self.zipfile is None or self.zipfile_pid != os.getpid()):
+            if (self.archive_data is not None):
+                self.zipfile = zipfile.ZipFile(io.BytesIO(self.archive_data))
+            else:
+                self.zipfile = zipfile.ZipFile(self.sourcedir)
+            self.zipfile_pid = os.getpid()
+        return self.zipfile
+
+    def cache_key(self):
+        # Image paths are found again in the extract directory of each run (see locate_images),
+        # and the resources of a flashcard are checked by their stamps : every archive shares the cache
+        return 'archive'
+
+    def source_id(self):
+        # A re-exported archive is another source, even under the same path
+        return self.content_hash
+
+    def quiz_files(self, file_name = None):
+        return [(workpath, file) for (workpath, file) in self.quiz_paths if file_name is None or file == file_name]
+
+    def read_quiz(self, workpath):
+        return self.archive().read(workpath)
+
+    def parse_quiz(self, workpath, parser):
+        with self.archive().open(workpath) as quiz:
+            return etree.parse(quiz, parser)
+
+    def open_quiz(self, workpath):
+        return self.archive().open(workpath)
+
+    def open_resource(self, location):
+        # Read from the archive stream, the resource does not need to be extracted
+        return self.archive().open(location)
+
+    def resource_stamp(self, location):
+        member = self.archive().getinfo(location)
+        return 'crc ' + str(member.CRC) + ' ' + str(member.file_size)
+
+    def resolve(self, location):
+        path = os.path.normpath(os.path.join(self.extract_dir, location.lstrip('/')))
+        if (not path.startswith(self.extract_dir + os.sep)):
+            write_logs(
+                'opale2flashcard.py: WARNING ! Resource outside of the archive ignored: ' + location,
+                'opale2flashcard.py: WARNING ! Resource outside of the archive ignored: ' + location
+            )
+            return None
+        if (not os.path.isfile(path)):
+            # Extract once, atomically (parsing workers may extract the same resource)
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+            with self.archive().open(location) as resource, open(tmp_path, 'wb') as extracted:
+                shutil.copyfileobj(resource, extracted)
+            os.replace(tmp_path, path)
+        return path
+
+# Resources probed ahead of parsing by ImageSizes.prefetch (.gif images are not supported on the flashcards)
+image_extensions = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+def locate_images(flashcard, resource_index):
+    # Image paths of a cached or stored flashcard, where this run finds (or extracts) its resources
+    # .gif images are converted by store_images with --image_dpi, not supported otherwise (see parse_file)
+    image = []
+    for location in flashcard.resources:
+        path = resource_index.resolve(location)
+        if (path is not None and (not path.endswith('.gif') or args.image_dpi is not None)):
+            image.append(path)
+    flashcard.image = image if len(image) > 0 else None
+
+def open_resource_index(sourcedir, extract_dir):
+    # sourcedir is either an unzipped .scar directory, a .scar/.zip archive, or the bytes of an archive
+    if (isinstance(sourcedir, bytes)):
+        return ArchiveResourceIndex(None, extract_dir, sourcedir)
+    if (os.path.isfile(sourcedir) and zipfile.is_zipfile(sourcedir)):
+        return ArchiveResourceIndex(sourcedir, extract_dir)
+    return ResourceIndex(sourcedir)
+
+class TexFilter:
+    # Applies every texfilter substitution in a single scan of the text, using one
+    # precompiled regex and a lookup dict.
+    # The regex is a character class, or an alternation if a user table has
+    # strings longer than one character.
+    # '%' and 'ˉ' are only replaced if the text has not been escaped yet,
+    # unless a user table gives their replacement, which is then always applied.
+    def __init__(self, table):
+        self.table = dict(table)
+        keys = set(self.table) | {'%', 'ˉ'}
+        if (all(len(key) == 1 for key in keys)):
+            self.regex = re.compile('[' + ''.join(re.escape(key) for key in sorted(keys)) + ']')
+        else:
+            self.regex = re.compile('|'.join(re.escape(key) for key in sorted(keys, key = len, reverse = True)))
+        self.lookups = {}
+        for escape_percent in (True, False):
+            for replace_macron in (True, False):
+                lookup = dict(self.table)
+                if ('%' not in self.table):
+                    lookup['%'] = '\\%' if escape_percent else '%'
+                if ('ˉ' not in self.table):
+                    lookup['ˉ'] = '$^{-}$' if replace_macron else 'ˉ'
+                self.lookups[(escape_percent, replace_macron)] = lookup
+
+    def apply(self, text):
+        lookup = self.lookups[('\\%' not in text, '$^{-}$' not in text)]
+        return self.regex.sub(lambda match: lookup[match.group(0)], text)
+
+def load_texfilter_table(filename):
+    # User substitutions (JSON object, e.g. {"ℓ" : "$\\ell$"}) extend or override the default table
+    table = dict(texfilter_table)
+    with open(filename, 'r', encoding = 'utf-8') as table_file:
+        user_table = json.load(table_file)
+    if (type(user_table) != dict or not all(type(key) == str and key != '' and type(value) == str for (key, value) in user_table.items())):
+        raise ValueError('texfilter table must map non-empty strings to strings')
+    table.update(user_table)
+    return table
+
+tex_filter = TexFilter(texfilter_table)
+
+class OutputSink:
+    # Keeps one buffered handle per output file (out.tex, out-rejected.tex,
+    # out-<subject>.tex, out-<subject>-rejected.tex, logs.txt) for the whole run,
+    # instead of reopening the file for every fragment.
+    # Handles are flushed and closed by close().
+    def __init__(self, output_dir, buffer_size = 1 << 20):
+        self.output_dir = output_dir
+        self.buffer_size = buffer_size
+        self.files = {}
+        # Characters written and offsets marked in each file, see mark()
+        self.lengths = {}
+        self.marks = {}
+
+    def outfile_path(self, subject):
+        if (subject is not None and subject != ''):
+            return os.path.join(self.output_dir, 'out-' + subject.lower() + '.tex')
+        return os.path.join(self.output_dir, 'out.tex')
+
+    def open(self, path, truncate = False):
+        outfile = self.files.get(path, None)
+        if (outfile is not None and truncate is False):
+            return outfile
+        if (outfile is not None):
+            outfile.close()
+        if (truncate is True and os.path.isfile(path)):
+            os.remove(path)
+        if (truncate is True):
+            self.lengths[path] = 0
+            self.marks[path] = []
+        outfile = open(path, 'a', encoding = 'utf-8', buffering = self.buffer_size)
+        self.files[path] = outfile
+        return outfile
+
+    def write(self, path, text):
+        self.open(path).write(text)
+        self.lengths[path] = self.lengths.get(path, 0) + len(text)
+
+    def tell(self, path):
+        return self.lengths.get(path, 0)
+
+    def mark(self, path, offset = None):
+        # Records an offset (the current end of the file by default) where the file can be split
+        if (offset is None):
+            offset = self.tell(path)
+        self.marks.setdefault(path, []).append(offset)
+
+    def close(self):
+        files = self.files
+        self.files = {}
+        for outfile in files.values():
+            outfile.close()
+
+# Output sink of the current run, set by run_conversion
+output_sink = None
+
+class Profiler:
+    # Wall and CPU time of the pipeline stages (--profile), and of every .quiz file.
+    # Stages measured while a file is parsed (between begin_file and end_file) are
+    # recorded for the file, the totals of every stage are kept in stages.
+    # Parsing workers return their file records to the parent (see parse_file_worker).
+    def __init__(self):
+        self.stages = {}
+        self.files = []
+        self.current = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # CPU time of the child processes (xelatex, converters) is counted apart
+        start = (time.perf_counter(), time.process_time(), os.times())
+        try:
+            yield
+        finally:
+            end = (time.perf_counter(), time.process_time(), os.times())
+            wall = end[0] - start[0]
+            cpu = end[1] - start[1]
+            children_cpu = (end[2].children_user + end[2].children_system) - (start[2].children_user + start[2].children_system)
+            if (self.current is not None):
+                timing = self.current['stages'].setdefault(name, {'wall' : 0.0, 'cpu' : 0.0})
+                timing['wall'] += wall
+                timing['cpu'] += cpu
+            else:
+                self.add_stage(name, wall, cpu, children_cpu)
+
+    def add_stage(self, name, wall, cpu, children_cpu = 0.0, calls = 1):
+        timing = self.stages.setdefault(name, {'wall' : 0.0, 'cpu' : 0.0, 'children_cpu' : 0.0, 'calls' : 0})
+        timing['wall'] += wall
+        timing['cpu'] += cpu
+        timing['children_cpu'] += children_cpu
+        timing['calls'] += calls
+
+    def begin_file(self, file):
+        self.current = {'file' : file, 'stages' : {}, 'start' : (time.perf_counter(), time.process_time())}
+
+    def end_file(self):
+        record = self.current
+        self.current = None
+        start = record.pop('start')
+        record['wall'] = time.perf_counter() - start[0]
+        record['cpu'] = time.process_time() - start[1]
+        return record
+
+    def add_file(self, record):
+        self.files.append(record)
+        for (name, timing) in record['stages'].items():
+            self.add_stage('file ' + name, timing['wall'], timing['cpu'])
+
+    def report(self):
+        return {
+            'stages' : self.stages,
+            'files' : sorted(self.files, key = lambda record: record['wall'], reverse = True),
+        }
+
+# Profiler of the current run, set by run_conversion when --profile is used
+profiler = None
+
+def profile_stage(name):
+    if (profiler is None):
+        return contextlib.nullcontext()
+    return profiler.stage(name)
+
+def file_hash(path):
+    # Sources given as bytes (see convert()) are hashed directly
+    if (isinstance(path, bytes)):
+        return hashlib.sha256(path).hexdigest()
+    sha = hashlib.sha256()
+    with open(path, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(1 << 16), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+class DiskCache:
+    # Size-bounded on-disk cache, one file per entry named after its key.
+    # Entries are written atomically, so that concurrent runs can share a cache.
+    # Hits refresh the entry's modification time, and the least recently used
+    # entries are removed once the cache grows over max_size bytes.
+    # Entries used through an instance are never removed by it : a run does not evict
+    # what it still has to link or merge, even if its own entries exceed max_size.
+    # Entries used in the last in_use_seconds are not removed either, other runs sharing
+    # the cache (e.g. the workers of compile_all.py) may still need them.
+    in_use_seconds = 3600
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.used = set()
+        os.makedirs(self.directory, exist_ok = True)
+        self.size = sum(os.path.getsize(path) for path in self.entries())
+
+    def entries(self):
+        return [entry.path for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith('.tmp')]
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        path = self.path(key)
+        self.used.add(path)
+        try:
+            with open(path, 'rb') as entry:
+                data = entry.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def touch(self, key):
+        # Refreshes an entry like get() without reading it, False if there is no such entry
+        self.used.add(self.path(key))
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            return False
+        return True
+
+    def put(self, key, data):
+        path = self.path(key)
+        self.used.add(path)
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+        previous_size = os.path.getsize(path) if os.path.isfile(path) else 0
+        with open(tmp_path, 'wb') as entry:
+            entry.write(data)
+        os.replace(tmp_path, path)
+        self.size += len(data) - previous_size
+        if (self.size > self.max_size):
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.entries():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self.size = sum(size for (mtime, size, path) in entries)
+        in_use_since = time.time() - self.in_use_seconds
+        for (mtime, size, path) in entries:
+            if (self.size <= self.max_size or mtime >= in_use_since):
+                break
+            if (path in self.used):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+# Share of --cache_size of each cache, so that together they stay under it
+cache_shares = {
+    'flashcards' : 0.2,
+    'cards' : 0.4,
+    'images' : 0.2,
+    'formats' : 0.1,
+    'artwork' : 0.05,
+    'image-sizes' : 0.05,
+}
+
+def get_cache_size(name):
+    # Maximum size in bytes of one of the caches (see cache_shares)
+    return int(args.cache_size * 1024 * 1024 * cache_shares[name])
+
+class FlashcardCache:
+    # Cache of parsed flashcards and of their TeX output, used for incremental rebuilds.
+    # Entries are keyed by the .quiz file content, the themes file and every option
+    # changing the parsed content or the output.
+    # An entry holds the parsed Flashcard, the messages logged while parsing it,
+    # and its TeX output for each layout and position it has been written at.
+    # It also holds the stamps of the resources the flashcard references : an entry
+    # whose images have changed (or have been added, moved, removed) is parsed again.
+    version = '7'
+
+    def __init__(self, directory, max_size, args, customqr_valid, resource_index):
+        self.disk_cache = DiskCache(directory, max_size)
+        # Image paths of a source directory are absolute, hence where resources are found
+        options = [
+            self.version,
+            file_hash(args.themefile),
+            resource_index.cache_key(),
+            file_hash(args.texfilter_table) if args.texfilter_table is not None else '',
+            str(customqr_valid),
+        ]
+        for option in ('add_url', 'no_replace', 'add_complexity_level', 'force', 'verbose', 'file_name', 'image_dpi', 'dedup_images'):
+            options.append(option + '=' + str(getattr(args, option)))
+        # Images of the output directory are written with relative paths (see get_image_path)
+        self.run_key = '\n'.join(options)
+        self.resource_index = resource_index
+        self.entries = {}
+        self.modified = set()
+
+    def key(self, content, file):
+        sha = hashlib.sha256(self.run_key.encode('utf-8'))
+        sha.update(b'\n' + file.encode('utf-8') + b'\n')
+        sha.update(content)
+        return sha.hexdigest()
+
+    def load(self, key):
+        data = self.disk_cache.get(key)
+        if (data is None):
+            return None
+        try:
+            entry = pickle.loads(data)
+        except Exception:
+            return None
+        if (entry['resources'] != self.resource_index.reference_stamps(entry['flashcard'].references)):
+            return None
+        self.entries[key] = entry
+        return (copy.copy(entry['flashcard']), entry['logs'])
+
+    def store(self, key, flashcard, logs):
+        # The flashcard is copied before it gets modified by process_flashcard
+        self.entries[key] = {'flashcard' : copy.copy(flashcard), 'logs' : logs, 'fragments' : {}, 'resources' : self.resource_index.reference_stamps(flashcard.references)}
+        self.modified.add(key)
+
+    def fragment(self, key, position):
+        entry = self.entries.get(key, None)
+        if (entry is None):
+            return None
+        return entry['fragments'].get(position, None)
+
+    def store_fragment(self, key, position, fragment):
+        entry = self.entries.get(key, None)
+        if (entry is not None):
+            entry['fragments'][position] = fragment
+            self.modified.add(key)
+
+    def flush(self):
+        for key in sorted(self.modified):
+            self.disk_cache.put(key, pickle.dumps(self.entries[key], protocol = pickle.HIGHEST_PROTOCOL))
+        self.modified = set()
+        # The size limit may have been lowered since the last run
+        if (self.disk_cache.size > self.disk_cache.max_size):
+            self.disk_cache.evict()
+
+# Flashcard cache of the current run, set by opale_to_tex when --cache-dir is used
+flashcard_cache = None
+
+class ImageSizes:
+    # Dimensions of the question images, which choose the square or rectangular layout.
+    # Only the image header is read (PIL decodes the pixels lazily) and the file is closed right away.
+    # Sizes are memoised by resource and by its stamp (modification time and size, CRC and size in an archive),
+    # and kept in a DiskCache with --cache-dir so that repeat runs do not open the images at all.
+    def __init__(self, disk_cache = None):
+        self.disk_cache = disk_cache
+        self.sizes = {}
+
+    def key(self, resource_index, location):
+        return hashlib.sha256((location + '\n' + resource_index.resource_stamp(location)).encode('utf-8')).hexdigest()
+
+    def size(self, resource_index, location):
+        key = self.key(resource_index, location)
+        size = self.sizes.get(key, None)
+        if (size is not None):
+            return size
+        data = self.disk_cache.get(key) if self.disk_cache is not None else None
+        if (data is not None):
+            size = tuple(int(value) for value in data.split())
+        else:
+            with resource_index.open_resource(location) as resource, Image.open(resource) as image:
+                size = image.size
+            if (self.disk_cache is not None):
+                self.disk_cache.put(key, (str(size[0]) + ' ' + str(size[1])).encode('ascii'))
+        self.sizes[key] = size
+        return size
+
+    def prefetch(self, resource_index, locations, threads):
+        # Probes the images concurrently before parsing, the parsing workers then find their sizes here
+        # (or in the disk cache for workers not started by fork)
+        def probe(location):
+            try:
+                self.size(resource_index, location)
+            except Exception:
+                # Reported by fetch_question if the flashcard uses the image
+                pass
+        pool = multiprocessing.pool.ThreadPool(processes = max(1, min(threads, len(locations))))
+        try:
+            pool.map(probe, locations)
+        finally:
+            pool.close()
+            pool.join()
+
+# Image sizes of the current run, persistent when opale_to_tex is given --cache-dir
+image_sizes = ImageSizes()
+# Threads probing the image sizes, reading headers is mostly waiting on the disk
+image_probe_threads = 16
+
+class FlashcardStore:
+    # SQLite database of the parsed flashcards of each source, as parse_file returns them
+    # (before --force fills the missing metadata), with the messages logged while parsing.
+    # Filtered runs (--from_store) select their flashcards with indexed queries instead of parsing again.
+    # Records are kept for each set of options changing the parsed content (run_key).
+    version = '1'
+    # Arguments of the Flashcard constructor, then the attributes set by the checks
+    constructor_fields = (
+        'file', 'question_type', 'complexity_level', 'subject', 'education_level', 'licence_theme',
+        'question', 'image', 'image_square', 'image_rectangular', 'choices', 'answer', 'solution_list', 'choice_number',
+        'subject_length', 'licence_theme_length', 'question_length', 'choices_length', 'answer_length',
+    )
+    check_fields = ('overflow_flag', 'err_flag', 'err_message', 'relevant', 'resources')
+    fields = constructor_fields + check_fields
+    # Stored as JSON
+    list_fields = ('image', 'choices', 'solution_list', 'resources')
+    flag_fields = ('image_square', 'image_rectangular', 'overflow_flag', 'err_flag', 'relevant')
+
+    def __init__(self, path, args):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS sources (
+                source TEXT NOT NULL, run_key TEXT NOT NULL, stored REAL NOT NULL,
+                PRIMARY KEY (source, run_key)
+            );
+            CREATE TABLE IF NOT EXISTS flashcards (
+                source TEXT NOT NULL, run_key TEXT NOT NULL, position INTEGER NOT NULL, ''' + ', '.join(self.fields) + ''', logs TEXT NOT NULL,
+                PRIMARY KEY (source, run_key, position)
+            );
+            CREATE INDEX IF NOT EXISTS flashcards_file ON flashcards (source, run_key, file);
+            CREATE INDEX IF NOT EXISTS flashcards_subject ON flashcards (source, run_key, subject);
+            CREATE INDEX IF NOT EXISTS flashcards_theme ON flashcards (source, run_key, licence_theme);
+            CREATE INDEX IF NOT EXISTS flashcards_flags ON flashcards (source, run_key, overflow_flag, err_flag, relevant);
+        ''')
+        options = [
+            self.version,
+            file_hash(args.themefile),
+            file_hash(args.texfilter_table) if args.texfilter_table is not None else '',
+        ]
+        for option in ('add_url', 'no_replace', 'add_complexity_level', 'force', 'verbose'):
+            options.append(option + '=' + str(getattr(args, option)))
+        # .gif images are kept with --image_dpi
+        options.append('gif=' + str(args.image_dpi is not None))
+        self.run_key = '\n'.join(options)
+
+    def save(self, source, results):
+        # results : (flashcard, logs) of every file of the source, in os.walk order
+        rows = []
+        for (position, (flashcard, logs)) in enumerate(results):
+            row = [source, self.run_key, position]
+            for field in self.fields:
+                value = getattr(flashcard, field)
+                if (field in self.list_fields and value is not None):
+                    value = json.dumps(value)
+                row.append(value)
+            row.append(json.dumps(logs))
+            rows.append(row)
+        with self.connection:
+            self.connection.execute('DELETE FROM flashcards WHERE source = ? AND run_key = ?', (source, self.run_key))
+            self.connection.executemany('INSERT INTO flashcards VALUES (' + ', '.join('?' * (len(self.fields) + 4)) + ')', rows)
+            self.connection.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?)', (source, self.run_key, time.time()))
+
+    def load(self, source, file_name = None, image_only = False, overflow_only = False, non_relevant_only = False):
+        # (flashcard, logs) of the selected files of the source, in os.walk order
+        # None if the source has not been stored with the options of the run
+        if (self.connection.execute('SELECT stored FROM sources WHERE source = ? AND run_key = ?', (source, self.run_key)).fetchone() is None):
+            return None
+        conditions = ['source = ?', 'run_key = ?']
+        parameters = [source, self.run_key]
+        if (file_name is not None):
+            conditions.append('file = ?')
+            parameters.append(file_name)
+        if (image_only is True):
+            conditions.append('image IS NOT NULL')
+        if (overflow_only is True):
+            conditions.append('overflow_flag = 1')
+        if (non_relevant_only is True):
+            conditions.append('relevant = 0')
+        results = []
+        query = 'SELECT ' + ', '.join(self.fields) + ', logs FROM flashcards WHERE ' + ' AND '.join(conditions) + ' ORDER BY position'
+        for row in self.connection.execute(query, parameters):
+            values = dict(zip(self.fields, row))
+            for field in self.list_fields:
+                if (values[field] is not None):
+                    values[field] = json.loads(values[field])
+            for field in self.flag_fields:
+                values[field] = bool(values[field])
+            flashcard = Flashcard(*(values[field] for field in self.constructor_fields))
+            for field in self.check_fields:
+                setattr(flashcard, field, values[field])
+            results.append((flashcard, [tuple(message) for message in json.loads(row[-1])]))
+        return results
+
+    def close(self):
+        self.connection.close()
+
+# Parsed flashcards store of the current run, set by run_conversion when --store is used
+flashcard_store = None
+
+# Written before the fonts of the header with --precompile_preamble.
+# mylatexformat dumps every line above it in a format file, and skips them when the format is loaded.
+# The fonts are loaded at every compilation : XeTeX cannot dump fonts loaded by fontspec.
+preamble_dump_marker = '\\csname endofdump\\endcsname\n'
+
 def remove_namespace(element):
     return etree.QName(element)
 
 def literal_QName(ns, tag):
     return '{' + namespace.get(ns) + '}' + tag
 
-def fetch_data(file, element, expression):
+# Paths searched in a .quiz document by the fetch_* functions, compiled once
+quiz_paths = {
+    'theme_code' : './/sp:themeLicence',
+    'level' : './/sp:level',
+    'education_level' : './/sp:educationLevel',
+    'question_res' : './/sc:question/op:res',
+    'choice' : './/sc:choice',
+    'choice_label' : './/sc:choice//sc:choiceLabel',
+    'choice_label_txt' : './/sc:choice//sc:choiceLabel//op:txt',
+    'choice_descendant' : './/sc:choice//*',
+    'choice_explanation_txt' : './/sc:choice//sc:choiceExplanation/op:txt',
+    'choice_explanation_descendant_txt' : './/sc:choice//sc:choiceExplanation//op:txt',
+    'global_explanation_txt' : './/sc:globalExplanation//op:txt',
+    'solution' : './/sc:solution',
+}
+xpath_namespaces = {prefix : uri for (prefix, uri) in namespace.items() if prefix != 'xml'}
+compiled_quiz_paths = {name : etree.XPath(path, namespaces = xpath_namespaces) for (name, path) in quiz_paths.items()}
+# Paths searched in an element of the question or the answer
+table_column_xpath = etree.XPath('.//sc:column', namespaces = xpath_namespaces)
+table_row_xpath = etree.XPath('.//sc:row', namespaces = xpath_namespaces)
+row_cell_xpath = etree.XPath('.//sc:cell', namespaces = xpath_namespaces)
+url_xpath = etree.XPath('.//sp:url', namespaces = xpath_namespaces)
+text_xpath = etree.XPath('text()')
+
+class QuizElements:
+    # Elements of a .quiz document by path name (see quiz_paths), shared by the fetch_* functions :
+    # each path is evaluated at most once per document, however many times it is looked up
+    def __init__(self, root):
+        self.root = root
+        self.found = {}
+
+    def get(self, name):
+        elements = self.found.get(name, None)
+        if (elements is None):
+            elements = compiled_quiz_paths[name](self.root)
+            self.found[name] = elements
+        return elements
+
+def fetch_data(file, quiz, name):
     data = []
     output = ''
-    for element in element.iterfind(expression, namespace):
+    for element in quiz.get(name):
         data.append(element.text)
     for x in data:
         output += x
@@ -241,15 +1166,19 @@ def get_subject_and_themes(filename, parser):
     licence_theme = {}
     subject = {}
 
-    # Theme file 
-    themefile = os.path.join(os.path.dirname(os.path.realpath(filename)), os.path.basename(filename))
-    # File check
-    if (themefile is None or os.path.isfile(themefile) is False):
-        write_logs(
-            "Themes list file does not exist (" + filename + ")",
-            "Themes list file does not exist (" + filename + ")"
-        )
-        return None 
+    # Theme file, or its content (see convert())
+    if (isinstance(filename, bytes)):
+        themefile = io.BytesIO(filename)
+        filename = 'bytes'
+    else:
+        themefile = os.path.join(os.path.dirname(os.path.realpath(filename)), os.path.basename(filename))
+        # File check
+        if (themefile is None or os.path.isfile(themefile) is False):
+            write_logs(
+                "Themes list file does not exist (" + filename + ")",
+                "Themes list file does not exist (" + filename + ")"
+            )
+            return None 
     
     # Parsing theme file
 
@@ -302,38 +1231,60 @@ def get_subject(subject_dict, subject_code):
     else:
         return ''
 
+# Format written by the current pass of a --formats run, in its own subdirectory
+output_format = None
+
 def get_output_directory():
-    if (os.path.basename(os.getcwd()) == 'cap_flashcards'):
-        if (args.output is not None):
-            if (not os.path.isdir(os.path.join("./Python/output", args.output))):
-                os.mkdir(os.path.join('./Python/output', args.output))
-            return os.path.join(os.getcwd(), 'Python/output', args.output)
-        else:
-            return os.path.join(os.getcwd(), 'Python/output')
-    elif (os.path.basename(os.getcwd()) == 'Python'):
-        if (args.output is not None):
-            if (not os.path.isdir(os.path.join("./output", args.output))):
-                os.mkdir(os.path.join('./output', args.output))
-            return os.path.join(os.getcwd(), 'output', args.output)
-        else:
-            return os.path.join(os.getcwd(), 'output')
+    # --output_dir, else /cap_flashcards/Python/output[/--output], whatever the current directory
+    # [/default or /a4paper] with --formats
+    if (args.output_dir is not None):
+        output_dir = os.path.abspath(args.output_dir)
+    elif (args.output is not None):
+        output_dir = os.path.join(script_dir, 'output', args.output)
     else:
-        write_logs(
-            "Current working directory is neither cap_flashcards nor Python",
-            "Current working directory is neither cap_flashcards nor Python"
-        )
+        output_dir = os.path.join(script_dir, 'output')
+    if (output_format is not None):
+        output_dir = os.path.join(output_dir, output_format)
+    if (not os.path.isdir(output_dir)):
+        os.makedirs(output_dir, exist_ok = True)
+    return output_dir
 
 def get_headers_directory():
-    if (os.path.basename(os.getcwd()) == 'cap_flashcards'):
-        return os.path.join(os.getcwd(), 'Python')
-    elif (os.path.basename(os.getcwd()) == 'Python'):
-        return os.getcwd()
-    else:
-        write_logs(
-            "Current working directory is neither cap_flashcards nor Python",
-            "Current working directory is neither cap_flashcards nor Python"
-        )
-        return None
+    return script_dir
+
+def get_image_path(path):
+    # Images of the output directory (extracted resources, image store) are included with a path
+    # relative to the directory of the .tex file : the output directory compiles anywhere else
+    root_dir = get_output_directory()
+    if (output_format is not None):
+        root_dir = os.path.dirname(root_dir)
+    if (os.path.isabs(path) and path.startswith(root_dir + os.sep)):
+        return os.path.relpath(path, get_output_directory()).replace(os.sep, '/')
+    return path
+
+def get_images_directory():
+    # Images (icons, artwork, qrcode) are shared by the output directories of the script,
+    # an --output_dir has its own (see link_shared_images)
+    if (args.output_dir is not None):
+        return os.path.join(os.path.abspath(args.output_dir), 'images')
+    return os.path.join(script_dir, 'output', 'images')
+
+def link_shared_images(images_dir):
+    # Job-local images directory : every shared image is linked, not copied,
+    # and the custom QR code is written there instead of in the shared directory
+    shared_dir = os.path.join(script_dir, 'output', 'images')
+    os.makedirs(images_dir, exist_ok = True)
+    for name in os.listdir(shared_dir):
+        path = os.path.join(images_dir, name)
+        if (name == 'custom_qrcode.png' or os.path.lexists(path)):
+            continue
+        try:
+            os.symlink(os.path.join(shared_dir, name), path)
+        except OSError:
+            if (os.path.isdir(os.path.join(shared_dir, name))):
+                shutil.copytree(os.path.join(shared_dir, name), path)
+            else:
+                shutil.copyfile(os.path.join(shared_dir, name), path)
 
 def check_metadata(flashcard):
     if (flashcard.complexity_level is None or flashcard.complexity_level == "Missing Complexity Level" and args.add_complexity_level is True 
@@ -359,7 +1310,7 @@ def check_metadata(flashcard):
 
 def check_generator(file, generator, expression):
     try:
-        next(generator)
+        next(iter(generator))
         return True
     except StopIteration:
         write_logs(
@@ -392,7 +1343,7 @@ def check_overflow(flashcard):
              or flashcard.answer_length > 615):
             flashcard.overflow_flag = True
             flashcard.err_message += 'opale2flashcard.py(' + flashcard.file +  '): Image - Potentially overflowing content (Q, C, A): ' + str(flashcard.question_length) + ' ' + str(flashcard.choices_length) + ' ' + str(flashcard.answer_length) + " "
-        if (flashcard.image.count("includegraphics") >= 2):
+        if (len(flashcard.image) >= 2):
             flashcard.overflow_flag = True
             write_logs(
                 'opale2flashcard.py(' + flashcard.file + '): WARNING ! There are at least two images in the question. Content might overflow',
@@ -471,21 +1422,33 @@ def check_output(output, err_count):
             'opale2flashcard.py (--file_name) DANGER ! Specified option "--non_relevant_only" did not work as expected. The error_count does not coincide with the number of flashcards',
         )
 
+# Messages logged by a parsing worker, sent back to the parent process
+log_buffer = None
+
 def write_logs(err_message, verb_err_message = None):
+    # Parsing workers gather their messages, the parent writes them in order
+    if (log_buffer is not None):
+        log_buffer.append((err_message, verb_err_message))
+        return
     if (args.logs == False):
         if (args.verbose == True and verb_err_message is not None):
             print(verb_err_message)
         elif (err_message is not None):
             print(err_message)
     else:
-        # Get output directory
-        output_dir = get_output_directory()
-        logsfile_path = os.path.join(output_dir, 'logs.txt')
-        logs = open(logsfile_path, 'a', encoding = 'utf-8')
         if (args.verbose == True and verb_err_message is not None):
-            logs.write(time.strftime('opale2flashcard.py:' + "%m-%d-%Y @ %H:%M:%S - ", time.localtime()) + verb_err_message + '\n')
+            message = time.strftime('opale2flashcard.py:' + "%m-%d-%Y @ %H:%M:%S - ", time.localtime()) + verb_err_message + '\n'
         elif (err_message is not None):
-            logs.write(time.strftime('opale2flashcard.py:' + "%m-%d-%Y @ %H:%M:%S - ", time.localtime()) + err_message + '\n')
+            message = time.strftime('opale2flashcard.py:' + "%m-%d-%Y @ %H:%M:%S - ", time.localtime()) + err_message + '\n'
+        else:
+            return
+        if (output_sink is not None):
+            output_sink.write(os.path.join(output_sink.output_dir, 'logs.txt'), message)
+        else:
+            # Get output directory
+            output_dir = get_output_directory()
+            with open(os.path.join(output_dir, 'logs.txt'), 'a', encoding = 'utf-8') as logs:
+                logs.write(message)
 
 
 def write_solution(question_type, solution_list, choice_number, question_num):
@@ -558,21 +1521,10 @@ def solution_positions_a4paper(question_count):
     
     return (x_shift_1, x_shift_2, y_shift_1, y_shift_2)
 
-def fetch_content(file, root, licence_theme_dict, subject_dict):
-    # Fetch data
-    # variables 
-    theme_code = None
+def get_subject_and_licence_theme(file, theme_code, licence_theme_dict, subject_dict):
+    # Subject and licence theme names of a themeLicence code, e.g. "#chim-electrochim-"
     subject = None
     licence_theme = None
-    complexity_level = None
-    education_level = None
-    ## Type question : mcqSur, mcqMur
-    if (remove_namespace(root[0]).localname == "mcqSur"):
-        question_type = "mcqSur"
-    if (remove_namespace(root[0]).localname == "mcqMur"):
-        question_type = "mcqMur"
-    ## Licence Theme and subject
-    theme_code = fetch_data(file, root, ".//sp:themeLicence")
     if (theme_code is not None and theme_code != ''):
         
         splitted = theme_code.split('-')
@@ -622,18 +1574,38 @@ def fetch_content(file, root, licence_theme_dict, subject_dict):
         subject = None
         licence_theme = None
 
+    return (subject, licence_theme)
+
+def fetch_content(file, root, licence_theme_dict, subject_dict, resource_index):
+    # Fetch data
+    # variables 
+    theme_code = None
+    subject = None
+    licence_theme = None
+    complexity_level = None
+    education_level = None
+    quiz = QuizElements(root)
+    ## Type question : mcqSur, mcqMur
+    if (remove_namespace(root[0]).localname == "mcqSur"):
+        question_type = "mcqSur"
+    if (remove_namespace(root[0]).localname == "mcqMur"):
+        question_type = "mcqMur"
+    ## Licence Theme and subject
+    theme_code = fetch_data(file, quiz, 'theme_code')
+    (subject, licence_theme) = get_subject_and_licence_theme(file, theme_code, licence_theme_dict, subject_dict)
+
     ## Complexity level
-    complexity_level = get_complexity_level(fetch_data(file, root, ".//sp:level"))
+    complexity_level = get_complexity_level(fetch_data(file, quiz, 'level'))
     ## Education level
-    education_level = fetch_data(file, root, ".//sp:educationLevel")
+    education_level = fetch_data(file, quiz, 'education_level')
     ## Content
     ### Question
 
-    (question, question_length, image, square, rectangular) = fetch_question(file, root)
-    (choices, choices_length) = fetch_choices(file, root)
+    (question, question_length, image, square, rectangular, resources, references) = fetch_question(file, quiz, resource_index)
+    (choices, choices_length) = fetch_choices(file, quiz)
     ### Answer
-    (answer, answer_length) = fetch_answer(file, root)
-    (solution_list, choice_number) = fetch_solution(file, root, question_type)
+    (answer, answer_length) = fetch_answer(file, quiz)
+    (solution_list, choice_number) = fetch_solution(file, quiz, question_type)
 
     # Create Flashcard instance
     
@@ -648,6 +1620,8 @@ def fetch_content(file, root, licence_theme_dict, subject_dict):
         licence_theme_length = len(licence_theme)
     
     flashcard = Flashcard(file, question_type, complexity_level, subject, education_level, licence_theme, question, image, square, rectangular, choices, answer, solution_list, choice_number, subject_length, licence_theme_length, question_length, choices_length, answer_length)
+    flashcard.resources = resources
+    flashcard.references = references
 
     return flashcard
 
@@ -667,67 +1641,11 @@ def output_cleanup(output):
     return output
 
 def texfilter(text):
-    # text = text.replace('~','\\textasciitilde')
-    # text = text.replace('^','\\textasciicircum')
-    # text = text.replace('&','\\&')
-    if ('\%' not in text):
-        text = text.replace('%','\\%')
-    if ('$^{-}$' not in text):
-        text = text.replace('ˉ', '$^{-}$')
-    # text = text.replace('$','\\$')
-    # text = text.replace('#','\\#')
-    # text = text.replace('_','\\_')
-    # text = output_cleanup(text)
-    text = text.replace('α', '$\\alpha$')
-    text = text.replace('Α', '$\\Alpha$')
-    text = text.replace('β', '$\\beta$')
-    text = text.replace('Β', '$\\Beta$')
-    text = text.replace('γ', '$\\gamma$')
-    text = text.replace('Γ', '$\\Gamma$')
-    text = text.replace('δ', '$\\delta$')
-    text = text.replace('Δ', '$\\Delta$')
-    text = text.replace('ε', '$\\epsilon$')
-    text = text.replace('Ε', '$\\Epsilon$')
-    text = text.replace('ζ', '$\\zeta$')
-    text = text.replace('Ζ', '$\\Zeta$')
-    text = text.replace('η', '$\\eta$')
-    text = text.replace('Η', '$\\Eta$')
-    text = text.replace('θ', '$\\theta$')
-    text = text.replace('Θ', '$\\Theta$')
-    text = text.replace('ι', '$\\iota$')
-    text = text.replace('Ι', '$\\Iota$')
-    text = text.replace('κ', '$\\kappa$')
-    text = text.replace('Κ', '$\\Kappa$')
-    text = text.replace('λ', '$\\lambda$')
-    text = text.replace('Λ', '$\\Lambda$')
-    text = text.replace('μ', '$\\mu$')
-    text = text.replace('Μ', '$\\Mu$')
-    text = text.replace('ν', '$\\nu$')
-    text = text.replace('Ν', '$\\Nu$')
-    text = text.replace('ξ', '$\\xi$')
-    text = text.replace('Ξ', '$\\Xi$')
-    text = text.replace('ο', 'o')
-    text = text.replace('Ο', 'O')
-    text = text.replace('π', '$\\pi$')
-    text = text.replace('Π', '$\\Pi$')
-    text = text.replace('ρ', '$\\rho$')
-    text = text.replace('Ρ', '$\\Rho$')
-    text = text.replace('σ', '$\\sigma$')
-    text = text.replace('Σ', '$\\Sigma$')
-    text = text.replace('τ', '$\\tau$')
-    text = text.replace('Τ', '$\\Tau$')
-    text = text.replace('υ', '$\\upsilon$')
-    text = text.replace('Υ', '$\\Upsilon$')
-    text = text.replace('φ', '$\\phi$')
-    text = text.replace('Φ', '$\\Phi$')
-    text = text.replace('χ', '$\\chi$')
-    text = text.replace('Χ', '$\\Chi$')
-    text = text.replace('ψ', '$\\psi$')
-    text = text.replace('Ψ', '$\\Psi$')
-    text = text.replace('ω', '$\\omega$')
-    text = text.replace('Ω', '$\\Omega$')
-    text = text.replace('→', '$\\longrightarrow$')
-    return text
+    # Called for every text fragment, the profiler is only looked up when used
+    if (profiler is None):
+        return tex_filter.apply(text)
+    with profiler.stage('texfilter'):
+        return tex_filter.apply(text)
 
 def markup_content(file, element):
     output = []
@@ -756,9 +1674,9 @@ def markup_content(file, element):
                 if (value == 'url' and args.add_url is not True):
                     role_markup = None
                 if (value == 'url'):
-                    for url in element.iterfind(".//sp:url", namespace):
+                    for url in url_xpath(element):
                         url = texfilter(url.text)
-                    text = element.xpath('text()')
+                    text = text_xpath(element)
                     text = output_cleanup(text[0])
                 # element.text = texfilter(element.text)
             else:
@@ -789,85 +1707,89 @@ def markup_content(file, element):
     output = output_cleanup(output)
     return ''.join(output)
 
-def tail_gen(file, node, url):
-    yield node
-    
-    for child in node:
-        if (args.add_url == True and child.attrib and child.attrib.keys()[0] == 'role' and child.attrib.values()[0] == 'url'):
-            # Don't strip the tail from the phrase node whose role is url.
-            url = True
-        yield from tail_gen(file, child, url)
-    
-    if node.tail is not None:
-        if (args.add_url == True):
-            if (url is not True):
-                tail = node.tail.strip()
-            elif (remove_namespace(node).localname == 'urlM'):
+def render_mixed_content(file, node):
+    # Walks the subtree of node (text, children, then tails) once and returns
+    # the TeX output and its length.
+    # An explicit stack is used instead of recursion, so that deeply nested content
+    # (e.g. tables) does not hit the recursion limit.
+    # Each frame is [element, url, children iterator], where url tells whether
+    # a phrase whose role is url has been met.
+    output = []
+    length = 0
+    stack = [[node, False, None]]
+    while stack:
+        frame = stack[-1]
+        element = frame[0]
+        # First visit of the element: its own text
+        if (frame[2] is None):
+            frame[2] = iter(element)
+            if (remove_namespace(element).localname != 'url' and element.text != ' '):
+                text = markup_content(file, element)
+                output.append(text)
+                length += len(text)
+                if (args.file_name == file and args.debug_mode is True):
+                    print("MIXED CONTENT PARSING ->" + ''.join(output) + '/')
+
+        # Then its children
+        child = next(frame[2], None)
+        if (child is not None):
+            if (args.add_url == True and child.attrib and child.attrib.keys()[0] == 'role' and child.attrib.values()[0] == 'url'):
+                # Don't strip the tail from the phrase node whose role is url.
+                frame[1] = True
+            stack.append([child, frame[1], None])
+            continue
+
+        # And finally its tail
+        stack.pop()
+        tail = element.tail
+        if (tail is not None and args.add_url == True):
+            if (frame[1] is True and remove_namespace(element).localname == 'urlM'):
                 tail = None
-                url = False
             else:
-                tail = node.tail.strip()
-        else:
-            if (remove_namespace(node).localname == 'phrase'):
-                tail = node.tail
-            else:
-                tail = node.tail
-    else:
-        tail = None
-    
-    if tail is not None:
-        yield tail
-
-def mixed_content_parsing(file, node):
-    output = ''
-    gen = tail_gen(file, node, False)
-    for element in gen:
-        if (type(element) != str):
-            if (remove_namespace(element).localname == 'url'):
-                continue
-        if ((type(element) == etree._Element)):
-            if (element.text != ' '):
-                output += markup_content(file, element)
+                tail = tail.strip()
+        if tail:
+            text = texfilter(tail)
+            output.append(text)
+            length += len(text)
             if (args.file_name == file and args.debug_mode is True):
-                print("MIXED CONTENT PARSING ->" + output + '/')
-        elif (element):
-            output += texfilter(element)
-            if (args.file_name == file and args.debug_mode is True):
-                print("MIXED CONTENT PARSING ->" + output + '/')                
-
+                print("MIXED CONTENT PARSING ->" + ''.join(output) + '/')
 
-    return output
+    return (''.join(output), length)
 
-def fetch_question(file, root):
+def fetch_question(file, quiz, resource_index):
     output = ''
     text_length = 0
     square = False
     rectangular = False
-    image_minipage = "\\hfill\n\\begin{minipage}[t]{0.35\linewidth}\n\\strut\\vspace*{-\\baselineskip}\\newline\n"
-    image = image_minipage
+    # Paths of the images, their TeX depends on the layout (see write_image)
+    image = []
     path_to_image = ''
+    image_location = None
+    resources = []
+    references = []
     # Questions can have rich content (images, etc.), so we examine every children
-    check_generator(file , root.iterfind(".//sc:question/op:res", namespace), './/sc:question/op:res')
-    for element in root.iterfind(".//sc:question/op:res", namespace):
+    check_generator(file , quiz.get('question_res'), './/sc:question/op:res')
+    for element in quiz.get('question_res'):
         for section in element.getchildren():
             # Section is a text paragraph
             if (remove_namespace(section).localname == 'txt'):
                 for child in section.find('op:txt', namespace):
                     # Text
                     if (remove_namespace(child).localname == 'para'):
-                        output += mixed_content_parsing(file, child)
-                        text_length += len(mixed_content_parsing(file, child))
+                        (text, length) = render_mixed_content(file, child)
+                        output += text
+                        text_length += length
                         output += '\n'
 
                     # Table 
                     if (remove_namespace(child).localname == 'table'):
                         output += "\n\\begin{center}\n\\tabcolsep=0.11cm\n\\begin{tabular}{"
-                        for column in child.iterfind(".//sc:column", namespace):
+                        for column in table_column_xpath(child):
                             output += '| c '
                         output += '|}\n'
-                        for row in child.iterfind(".//sc:row", namespace):
+                        for row in table_row_xpath(child):
                             output += '\hline\n'
-                            for cell in row.iterfind(".//sc:cell", namespace):
+                            for cell in row_cell_xpath(row):
                                 for content in cell.iter():
                                     if (content.text is not None and not str.isspace(content.text)):
                                         output += markup_content(file, content) + '&'
@@ -878,15 +1800,19 @@ def fetch_question(file, root):
 
             # Section is a ressource
             if (remove_namespace(section).localname == 'res'):
-                for root, dirs, files in os.walk(args.sourcedir):
-                    for name in files:
-                        if(name == section.attrib.values()[0].split("/")[-1]):
-                            path_to_image = os.path.abspath(os.path.join(root, name))
-                if (not path_to_image.endswith('.gif')):
-                    if (args.a4paper is True):
-                        image += "\\includegraphics[max size={\\cardwidth}{0.4\\cardheight}, center, keepaspectratio]{" + path_to_image + "}\n"
-                    else:
-                        image += "\\includegraphics[max size={\\textwidth}{0.4\\textheight}, center, keepaspectratio]{" + path_to_image + "}\n"
+                references.append(section.attrib.values()[0])
+                location = resource_index.locate(file, references[-1])
+                if (location is None):
+                    continue
+                path_to_resource = resource_index.resolve(location)
+                if (path_to_resource is None):
+                    continue
+                resources.append(location)
+                path_to_image = path_to_resource
+                image_location = location
+                # .gif images are converted by store_images with --image_dpi
+                if (not path_to_image.endswith('.gif') or args.image_dpi is not None):
+                    image.append(path_to_image)
                 else:
                     write_logs(
                         file + ' > Found a .gif ressource/image. Not supported',
@@ -894,14 +1820,14 @@ def fetch_question(file, root):
                     )
 
     # unchanged -> no image
-    if (image == image_minipage):
+    if (len(image) == 0):
         image = None
-    elif (image is not None):
-        image += '\n\\end{minipage}'
+    else:
         if (args.no_replace == False):
             output = output.replace("ci-dessous", "ci-contre")
         # print(path_to_image)
-        (width, height) = Image.open(path_to_image).size
+        with profile_stage('image'):
+            (width, height) = image_sizes.size(resource_index, image_location)
         if (width / height > 0.825):
             square = False
             rectangular = True
@@ -912,20 +1838,21 @@ def fetch_question(file, root):
     if (args.debug_mode is True and args.file_name == file):
         print('QUESTION\n' + output)
 
-    return (output, text_length, image, square, rectangular)
+    return (output, text_length, image, square, rectangular, resources, references)
 
-def fetch_choices(file, root):
+def fetch_choices(file, quiz):
     output_arr = []
     output = ''
     text_length = 0
     # Choice is text-only
-    check_generator(file, root.iterfind(".//sc:choice//sc:choiceLabel", namespace), './/sc:choice//sc:choiceLabel')
+    check_generator(file, quiz.get('choice_label'), './/sc:choice//sc:choiceLabel')
     i = 1
-    for element in root.iterfind(".//sc:choice//sc:choiceLabel//op:txt", namespace):
+    for element in quiz.get('choice_label_txt'):
         output += '\\item [' + str(i) + '.]'
         for child in element.getchildren():
-            output += mixed_content_parsing(file, child)
-            text_length += len(mixed_content_parsing(file, child))
+            (text, length) = render_mixed_content(file, child)
+            output += text
+            text_length += length
         if(output == '\\item [' + str(i) + '.]'):
             output = ''
         else:
@@ -940,7 +1867,7 @@ def fetch_choices(file, root):
     
     return (output_arr, text_length)
 
-def fetch_answer(file, root):
+def fetch_answer(file, quiz):
     output = ''
     text_length = 0
     number_list = []
@@ -948,16 +1875,16 @@ def fetch_answer(file, root):
     choice_number = 0
 
     # Explanations for each choices
-    choice_explanation_bool = check_generator(file, root.iterfind(".//sc:choice//sc:choiceExplanation//op:txt", namespace), './/sc:choice//sc:choiceExplanation//op:txt')
+    choice_explanation_bool = check_generator(file, quiz.get('choice_explanation_descendant_txt'), './/sc:choice//sc:choiceExplanation//op:txt')
     if (choice_explanation_bool == True):
         output += '\\begin{enumerate}\n'
         # Associate each explanation to a choice number
-        for choice in root.iterfind(".//sc:choice//", namespace):
+        for choice in quiz.get('choice_descendant'):
             if (remove_namespace(choice.tag).localname == 'choiceLabel'):
                 choice_number += 1
             if (remove_namespace(choice.tag).localname == 'choiceExplanation'):
                 number_list.append(choice_number)
-    for element in root.iterfind(".//sc:choice//sc:choiceExplanation/op:txt", namespace):
+    for element in quiz.get('choice_explanation_txt'):
         text = ''
         for e in element.iter():
             # Find text
@@ -968,23 +1895,24 @@ def fetch_answer(file, root):
         if (text != ''):
             output += '\\item [' + str(number_list[number_counter]) +'.]'
         for child in element.getchildren():
-            choice_explanation = mixed_content_parsing(file, child)
-            text_length += len(mixed_content_parsing(file, child))
+            (choice_explanation, length) = render_mixed_content(file, child)
+            text_length += length
             # op:txt can exist if there is a comment
             if (choice_explanation != ''):
                 output += choice_explanation
                 output += '\n'
         number_counter += 1
         
-    if (check_generator(file, root.iterfind(".//sc:choice//sc:choiceExplanation//op:txt", namespace), './/sc:choice//sc:choiceExplanation//op:txt') == True):
+    if (check_generator(file, quiz.get('choice_explanation_descendant_txt'), './/sc:choice//sc:choiceExplanation//op:txt') == True):
         output += '\\end{enumerate}\n'
 
     # Global Explanation
-    global_explanation_bool = check_generator(file , root.iterfind(".//sc:globalExplanation//op:txt", namespace), './/sc:globalExplanation//op:txt')
-    for element in root.iterfind(".//sc:globalExplanation//op:txt", namespace):
+    global_explanation_bool = check_generator(file , quiz.get('global_explanation_txt'), './/sc:globalExplanation//op:txt')
+    for element in quiz.get('global_explanation_txt'):
         for child in element.getchildren():
-            output += mixed_content_parsing(file, child)
-            text_length += len(mixed_content_parsing(file, child))
+            (text, length) = render_mixed_content(file, child)
+            output += text
+            text_length += length
             output += '\n\n'
 
     if (choice_explanation_bool and global_explanation_bool):
@@ -1011,12 +1939,12 @@ def fetch_answer(file, root):
     
     return (output, text_length)
 
-def fetch_solution(file, root, question_type):
+def fetch_solution(file, quiz, question_type):
     solution_list = []
     choice_number = 0 
 
     if (question_type == 'mcqMur'):
-        for choice in root.findall(".//sc:choice", namespace):
+        for choice in quiz.get('choice'):
             if (args.file_name == file and args.debug_mode is True):
                 print(choice.attrib)
             if (choice.attrib):
@@ -1025,10 +1953,10 @@ def fetch_solution(file, root, question_type):
                     solution_list.append(choice_number)
     
     if (question_type == 'mcqSur'):
-        for choice in root.findall(".//sc:choice", namespace):
+        for choice in quiz.get('choice'):
             choice_number += 1
 
-        for solution in root.iterfind(".//sc:solution", namespace):
+        for solution in quiz.get('solution'):
             solution_list = [int(i) for i in solution.attrib.values()]
 
     if (not solution_list):
@@ -1121,13 +2049,18 @@ def write_accepted(flashcard, output, accepted, flashcard_list, current_index, a
     
     return (accepted, accepted_kvp_last_index, next_accepted_index, accepted_fc_number, accepted_last_file)
     
+def is_accepted(flashcard):
+    # Accepted flashcards are written to out.tex, the others to out-rejected.tex
+    # --force accepts the flashcards in error, but not the near-duplicates flagged by --duplicates flag
+    return (flashcard.err_flag is False and flashcard.overflow_flag is False and flashcard.relevant is True or args.force is True) and flashcard.duplicate_of is None
+
 def write_flashcard(flashcard, output, accepted, rejected, flashcard_list, current_index, accepted_kvp_last_index, next_accepted_index, rejected_kvp_last_index, next_rejected_index, customqr_valid):
     accepted_fc_number = -1
     rejected_fc_number = -1
     accepted_last_file = ""
     rejected_last_file = ""
     
-    if (flashcard.err_flag is False and flashcard.overflow_flag is False and flashcard.relevant is True or args.force == True):
+    if (is_accepted(flashcard)):
         (accepted, accepted_kvp_last_index, next_accepted_index, accepted_fc_number, accepted_last_file) = write_accepted(flashcard, output, accepted, flashcard_list, current_index, accepted_kvp_last_index, next_accepted_index, rejected_kvp_last_index, next_rejected_index, customqr_valid)
     else:
         (rejected, rejected_kvp_last_index, next_rejected_index, rejected_fc_number, rejected_last_file) = write_rejected(flashcard, output, rejected, flashcard_list, current_index, accepted_kvp_last_index, next_accepted_index, rejected_kvp_last_index, next_rejected_index, customqr_valid)
@@ -1223,7 +2156,7 @@ def write_output(flashcard, question_num, customqr_valid):
     # End image minipage
     if (flashcard.image is not None):
         output.append('\\end{minipage}\n')
-        output.append(flashcard.image + '\n')
+        output.append(write_image(flashcard.image) + '\n')
 
     # Image is rectangular, 2x2 grid
     if (flashcard.image_rectangular is True):
@@ -1250,14 +2183,44 @@ def write_output(flashcard, question_num, customqr_valid):
     
     return output
 
+def write_image(image):
+    # Image minipage of a question, sized for the card of the layout
+    output = "\\hfill\n\\begin{minipage}[t]{0.35\linewidth}\n\\strut\\vspace*{-\\baselineskip}\\newline\n"
+    for path_to_image in map(get_image_path, image):
+        if (args.a4paper is True):
+            output += "\\includegraphics[max size={\\cardwidth}{0.4\\cardheight}, center, keepaspectratio]{" + path_to_image + "}\n"
+        else:
+            output += "\\includegraphics[max size={\\textwidth}{0.4\\textheight}, center, keepaspectratio]{" + path_to_image + "}\n"
+    return output + '\n\\end{minipage}'
+
+def render_flashcard(flashcard, question_num, customqr_valid):
+    # TeX output of a flashcard, reused from the cache if possible
+    # The output only depends on the layout, and on the position in the page in a4paper mode
+    if (flashcard_cache is None or flashcard.cache_key is None):
+        return write_output(flashcard, question_num, customqr_valid)
+    # Image paths are relative to the format subdirectory with --formats (see get_image_path)
+    if (args.a4paper is True):
+        position = ('a4paper', (question_num - 1) % 6, output_format is not None)
+    else:
+        position = ('default', 0, output_format is not None)
+    output = flashcard_cache.fragment(flashcard.cache_key, position)
+    if (output is None):
+        output = write_output(flashcard, question_num, customqr_valid)
+        flashcard_cache.store_fragment(flashcard.cache_key, position, output)
+    return output
 
-def write_background_parameter(flashcard):
+def background_artwork(subject):
+    # Artwork of a subject, in the order of the \backgroundparam parameters
     if (args.a4paper is False):
-        backgroundparam = ['\\backgroundparam\n{' + flashcard.subject.lower() + '}\n{' + flashcard.subject.lower() + '-front-header}\n{' + flashcard.subject.lower() + '-front-footer}\n{' + flashcard.subject.lower() + '-back-background}\n{' + flashcard.subject.lower() + '-back-header}\n{' + flashcard.subject.lower() + '-back-footer}\n{front-university-logo}\n{back-university-logo}\n']
+        prefix = subject.lower()
     else:
-        backgroundparam = ['\\backgroundparam\n{' + flashcard.subject.lower() + '}\n{' + flashcard.subject.lower() + '-precropped-front-header}\n{' + flashcard.subject.lower() + '-precropped-front-footer}\n{' + flashcard.subject.lower() + '-precropped-back-background}\n{' + flashcard.subject.lower() + '-precropped-back-header}\n{' + flashcard.subject.lower() + '-precropped-back-footer}\n{front-university-logo}\n{back-university-logo}\n']
+        prefix = subject.lower() + '-precropped'
+    return [prefix + '-front-header', prefix + '-front-footer', prefix + '-back-background', prefix + '-back-header', prefix + '-back-footer', 'front-university-logo', 'back-university-logo']
 
-    if (flashcard.err_flag is False and flashcard.overflow_flag is False and flashcard.relevant is True or args.force is True):
+def write_background_parameter(flashcard):
+    backgroundparam = ['\\backgroundparam\n{' + flashcard.subject.lower() + '}\n' + ''.join('{' + name + '}\n' for name in background_artwork(flashcard.subject))]
+
+    if (is_accepted(flashcard)):
         if (args.a4paper is False):
             if (flashcard.subject == ''):
                 write_outfile(backgroundparam, 'unclassifiable')
@@ -1274,42 +2237,44 @@ def write_background_parameter(flashcard):
         write_outfile(backgroundparam, 'rejected')
     
 def write_outfile(output, subject):
-    # Get output directory
-    output_dir = get_output_directory()
-    if (subject is not None and subject != ''):
-        outfile_path = os.path.join(output_dir, 'out-' + subject.lower() + '.tex')
-    else:
-        outfile_path = os.path.join(output_dir, 'out.tex')
-    # Open outfile
-    outfile = open(os.open(outfile_path, os.O_WRONLY | os.O_CREAT, 0o700), 'a', encoding = 'utf-8')
     # Write content
-    outfile.write(''.join(output))
-    outfile.close
+    output_sink.write(output_sink.outfile_path(subject), ''.join(output))
 
-def write_outfile_header(subject_set, customqr_valid):
-    # Get output directory
-    output_dir = get_output_directory()
+def write_outfile_header(subject_set, customqr_valid, artwork_converted):
+    output_dir = output_sink.output_dir
     if ('' in subject_set and args.a4paper is False):
         outfile_path = os.path.join(output_dir, 'out-unclassifiable.tex')
-        write_header(output_dir, outfile_path, customqr_valid)
+        write_header(output_dir, outfile_path, customqr_valid, artwork_converted)
         outfile_path = os.path.join(output_dir, 'out-unclassifiable-rejected.tex')
-        write_header(output_dir, outfile_path, customqr_valid)
+        write_header(output_dir, outfile_path, customqr_valid, artwork_converted)
         subject_set.remove('')
         
     if (args.a4paper is False):
         for subject in subject_set:
             outfile_path = os.path.join(output_dir, 'out-' + subject.lower() + '.tex')
-            write_header(output_dir, outfile_path, customqr_valid)
+            write_header(output_dir, outfile_path, customqr_valid, artwork_converted)
             outfile_path = os.path.join(output_dir, 'out-' + subject.lower() + '-rejected.tex')
-            write_header(output_dir, outfile_path, customqr_valid)
+            write_header(output_dir, outfile_path, customqr_valid, artwork_converted)
 
     outfile_path = os.path.join(output_dir, 'out.tex')
-    write_header(output_dir, outfile_path, customqr_valid)
+    write_header(output_dir, outfile_path, customqr_valid, artwork_converted)
 
     outfile_path = os.path.join(output_dir, 'out-rejected.tex')
-    write_header(output_dir, outfile_path, customqr_valid)
+    write_header(output_dir, outfile_path, customqr_valid, artwork_converted)
     
-def write_header(output_dir, outfile_path, customqr_valid):
+def get_graphicspath(artwork_converted):
+    # Images are in output/images (or in the --output_dir), converted artwork in the output directory
+    if (output_format is not None):
+        images_path = '{' + os.path.relpath(get_images_directory(), get_output_directory()).replace(os.sep, '/') + '/}'
+    elif (args.output is not None and args.output_dir is None):
+        images_path = '{../images//}'
+    else:
+        images_path = '{./images/}'
+    if (artwork_converted is True):
+        return '\\graphicspath{{./artwork/}' + images_path + '}\n'
+    return '\\graphicspath{' + images_path + '}\n'
+
+def write_header(output_dir, outfile_path, customqr_valid, artwork_converted):
     # Get headers' directory
     headers_dir = get_headers_directory()
     header_default_path = os.path.join(headers_dir, 'header_default.tex')
@@ -1318,17 +2283,24 @@ def write_header(output_dir, outfile_path, customqr_valid):
     # Directory and file output
     if os.path.isdir(output_dir) is None:
         os.mkdir(output_dir)
-    if os.path.isfile(outfile_path):
-        os.remove(outfile_path)
 
-    # Open outfile
-    outfile = open(os.open(outfile_path, os.O_WRONLY | os.O_CREAT, 0o700), 'a', encoding = 'utf-8')
+    # Open outfile, overwriting any previous output
+    output_sink.open(outfile_path, truncate = True)
+
+    def write_line(line):
+        # Artwork converted to PDF is included without inkscape
+        if (artwork_converted is True):
+            line = line.replace('\\includesvg', '\\includegraphics')
+        output_sink.write(outfile_path, line)
 
     # Select header
     if (args.a4paper == True):
-        header = open(header_a4paper_path,'r', encoding="utf-8")
+        with open(header_a4paper_path,'r', encoding="utf-8") as header:
+            header_lines = header.readlines()
         # Write header
-        for line in header.readlines():
+        for line in header_lines:
+            if (args.precompile_preamble is True and line.startswith('%%% FONTS')):
+                write_line(preamble_dump_marker)
             if ('% Graphicspath' not in line
              and '% QRCODE 1' not in line
              and '% QRCODE 2' not in line
@@ -1336,68 +2308,61 @@ def write_header(output_dir, outfile_path, customqr_valid):
              and '% QRCODE 4' not in line
              and '% QRCODE 5' not in line
              and '% QRCODE 6' not in line):
-                outfile.write(line)
+                write_line(line)
             elif('% Graphicspath' in line):
-                if (args.output is not None):
-                    outfile.write('\graphicspath{{../images//}}\n')
-                else:
-                    outfile.write('\graphicspath{{./images/}}\n')
+                write_line(get_graphicspath(artwork_converted))
             elif('% QRCODE 1' in line):
                 if (customqr_valid is True):
-                    outfile.write('                        \includegraphics[width = 0.120\cardwidth, keepaspectratio]{\FCone@qrcode}\n')
+                    write_line('                        \includegraphics[width = 0.120\cardwidth, keepaspectratio]{\FCone@qrcode}\n')
                 else:
-                    outfile.write('                        \includesvg[height = 0.140\cardheight]{\FCone@qrcode}\n')
+                    write_line('                        \includesvg[height = 0.140\cardheight]{\FCone@qrcode}\n')
             elif('% QRCODE 2' in line):
                 if (customqr_valid is True):
-                    outfile.write('                        \includegraphics[width = 0.120\cardwidth, keepaspectratio]{\FCtwo@qrcode}\n')
+                    write_line('                        \includegraphics[width = 0.120\cardwidth, keepaspectratio]{\FCtwo@qrcode}\n')
                 else:
-                    outfile.write('                        \includesvg[height = 0.140\cardheight]{\FCtwo@qrcode}\n')
+                    write_line('                        \includesvg[height = 0.140\cardheight]{\FCtwo@qrcode}\n')
             elif('% QRCODE 3' in line):
                 if (customqr_valid is True):
-                    outfile.write('                        \includegraphics[width = 0.120\cardwidth, keepaspectratio]{\FCthree@qrcode}\n')
+                    write_line('                        \includegraphics[width = 0.120\cardwidth, keepaspectratio]{\FCthree@qrcode}\n')
                 else:
-                    outfile.write('                        \includesvg[height = 0.140\cardheight]{\FCthree@qrcode}\n')
+                    write_line('                        \includesvg[height = 0.140\cardheight]{\FCthree@qrcode}\n')
             elif('% QRCODE 4' in line):
                 if (customqr_valid is True):
-                    outfile.write('                        \includegraphics[width = 0.120\cardwidth, keepaspectratio]{\FCfour@qrcode}\n')
+                    write_line('                        \includegraphics[width = 0.120\cardwidth, keepaspectratio]{\FCfour@qrcode}\n')
                 else:
-                    outfile.write('                        \includesvg[height = 0.140\cardheight]{\FCfour@qrcode}\n')
+                    write_line('                        \includesvg[height = 0.140\cardheight]{\FCfour@qrcode}\n')
             elif('% QRCODE 5' in line):
                 if (customqr_valid is True):
-                    outfile.write('                        \includegraphics[width = 0.120\cardwidth, keepaspectratio]{\FCfive@qrcode}\n')
+                    write_line('                        \includegraphics[width = 0.120\cardwidth, keepaspectratio]{\FCfive@qrcode}\n')
                 else:
-                    outfile.write('                        \includesvg[height = 0.140\cardheight]{\FCfive@qrcode}\n')
+                    write_line('                        \includesvg[height = 0.140\cardheight]{\FCfive@qrcode}\n')
             elif('% QRCODE 6' in line):
                 if (customqr_valid is True):
-                    outfile.write('                        \includegraphics[width = 0.120\cardwidth, keepaspectratio]{\FCsix@qrcode}\n')
+                    write_line('                        \includegraphics[width = 0.120\cardwidth, keepaspectratio]{\FCsix@qrcode}\n')
                 else:
-                    outfile.write('                        \includesvg[height = 0.140\cardheight]{\FCsix@qrcode}\n')
+                    write_line('                        \includesvg[height = 0.140\cardheight]{\FCsix@qrcode}\n')
     else:
-        header = open(header_default_path,'r', encoding="utf-8")
+        with open(header_default_path,'r', encoding="utf-8") as header:
+            header_lines = header.readlines()
         # Write header
-        for line in header.readlines():
+        for line in header_lines:
+            if (args.precompile_preamble is True and line.startswith('%%% FONTS')):
+                write_line(preamble_dump_marker)
             if ('% Graphicspath' not in line and '% QRCODE' not in line):
-                outfile.write(line)
+                write_line(line)
             elif('% Graphicspath' in line):
-                if (args.output is not None):
-                    outfile.write('\graphicspath{{../images//}}\n')
-                else:
-                    outfile.write('\graphicspath{{./images/}}\n')
+                write_line(get_graphicspath(artwork_converted))
             elif('% QRCODE' in line):
                 if (customqr_valid is True):
-                    outfile.write('                        \\includegraphics[width = 0.150\\textwidth, keepaspectratio]{#4}\n')
+                    write_line('                        \\includegraphics[width = 0.150\\textwidth, keepaspectratio]{#4}\n')
                 else:
-                    outfile.write('                        \\includesvg[height = 0.140\\textheight]{#4}\n')
+                    write_line('                        \\includesvg[height = 0.140\\textheight]{#4}\n')
                     # TODO : inverted logo ? #4 -> #4-inverted
             
-    outfile.write('\n\n')
-    header.close
-
-    outfile.close 
+    write_line('\n\n')
 
 def write_outfile_footer(subject_set):
-    # Get output directory
-    output_dir = get_output_directory()
+    output_dir = output_sink.output_dir
     if ('' in subject_set and args.a4paper is False):
         outfile_path = os.path.join(output_dir, 'out-unclassifiable.tex')
         write_footer(output_dir, outfile_path)
@@ -1423,16 +2388,11 @@ def write_footer(output_dir, outfile_path):
     headers_dir = get_headers_directory()
     footer_path = os.path.join(headers_dir, 'footer.tex')
     
-    # Open outfile 
-    outfile = open(os.open(outfile_path, os.O_WRONLY | os.O_CREAT, 0o700), 'a', encoding = 'utf-8')
-
-    # Write footer
-    outfile.write('\n\n')
-    footer = open(footer_path,'r', encoding="utf-8")
-    for line in footer.readlines():
-        outfile.write(line)
-    
-    footer.close
+    # Write footer, the end of the last card or page
+    output_sink.mark(outfile_path)
+    output_sink.write(outfile_path, '\n\n')
+    with open(footer_path,'r', encoding="utf-8") as footer:
+        output_sink.write(outfile_path, footer.read())
 
 def write_kvp(flashcard_list, current_index, status, customqr_valid):
     # Status = accepted/rejected.
@@ -1444,8 +2404,8 @@ def write_kvp(flashcard_list, current_index, status, customqr_valid):
     
     # Find every accepted/rejected flashcards and their positions in flashcard_list
     # Write metadata
-    while len(kvp_settings_all) < 6 and i < len(flashcard_list) and flashcard_list[i].subject is chosen_subject:
-        flashcard_validity = flashcard_list[i].err_flag is False and flashcard_list[i].overflow_flag is False and flashcard_list[i].relevant is True or args.force is True
+    while len(kvp_settings_all) < 6 and i < len(flashcard_list) and flashcard_list[i].subject == chosen_subject:
+        flashcard_validity = is_accepted(flashcard_list[i])
         flashcard_subject = flashcard_list[i].subject
         if (status is False):
             # Only accept rejected flashcards
@@ -1483,13 +2443,13 @@ def write_kvp(flashcard_list, current_index, status, customqr_valid):
     
     # Search next index
     if (i != len(flashcard_list)):
-        flashcard_validity = flashcard_list[i].err_flag is False and flashcard_list[i].overflow_flag is False and flashcard_list[i].relevant is True or args.force is True
+        flashcard_validity = is_accepted(flashcard_list[i])
         if (status is False):
             flashcard_validity = not flashcard_validity
 
         while(i < len(flashcard_list)-1 and flashcard_validity is False):
             i += 1
-            flashcard_validity = flashcard_list[i].err_flag is False and flashcard_list[i].overflow_flag is False and flashcard_list[i].relevant is True or args.force is True
+            flashcard_validity = is_accepted(flashcard_list[i])
             if (status is False):
                 flashcard_validity = not flashcard_validity
 
@@ -1506,7 +2466,7 @@ def write_empty_flashcards(accepted_lfile, accepted_last_file, rejected_lfile, r
     if (rejected_fc_number != -1):
         rejected_fc_nb = rejected_fc_number
     
-    if (flashcard.err_flag is False and flashcard.overflow_flag is False and flashcard.relevant is True or args.force is True):
+    if (is_accepted(flashcard)):
         # Accepted
         if (accepted_lfile == previous_accepted_file):
             for fc in range(0, 6 - accepted_fc_nb):
@@ -1558,20 +2518,31 @@ def write_flashcards(flashcard_list, customqr_valid):
         if (args.a4paper is True):
             (accepted_lfile, accepted_last_file, rejected_lfile, rejected_last_file, accepted_fc_nb, accepted_fc_number, rejected_fc_nb, rejected_fc_number, previous_accepted_file, previous_rejected_file) = write_empty_flashcards(accepted_lfile, accepted_last_file, rejected_lfile, rejected_last_file, accepted_fc_nb, accepted_fc_number, rejected_fc_nb, rejected_fc_number, previous_accepted_file, previous_rejected_file, flashcard)
             
+        # out.tex and out-<subject>.tex can be split before the background parameters of a card
+        split_paths = [output_sink.outfile_path(None)]
+        if (args.a4paper is False and flashcard.subject != ''):
+            split_paths.append(output_sink.outfile_path(flashcard.subject))
+        card_starts = [output_sink.tell(path) for path in split_paths]
+
         # Background parameters
         if (flashcard.subject != previous_subject):
-            if (flashcard.err_flag is False and flashcard.overflow_flag is False and flashcard.relevant is True or args.force is True):
+            if (is_accepted(flashcard)):
                 previous_subject = flashcard.subject
             write_background_parameter(flashcard)
         output.append("\n% QUESTION NUM "+ str(question_num)+"\n")
         # Create a standard output
-        for out in write_output(flashcard, g_valid_num, customqr_valid):
+        for out in render_flashcard(flashcard, g_valid_num, customqr_valid):
             output.append(out)
         question_num+=1
                 
         # Separate output according to flashcard validity
         (accepted, rejected, accepted_kvp_last_index, next_accepted_index, rejected_kvp_last_index, next_rejected_index, accepted_fc_number, accepted_last_file, rejected_fc_number, rejected_last_file) = process_write_outfile(flashcard, output, accepted, rejected, flashcard_list, current_index, accepted_kvp_last_index, next_accepted_index, rejected_kvp_last_index, next_rejected_index, customqr_valid)
-        if (flashcard.err_flag is False and flashcard.overflow_flag is False and flashcard.relevant is True or args.force == True):
+        # Split points for --compile-jobs and --compile_cards : every card, or every page (6 cards from write_kvp) in a4paper mode
+        for (path, card_start) in zip(split_paths, card_starts):
+            if (args.a4paper is False and output_sink.tell(path) > card_start
+             or args.a4paper is True and accepted_fc_number != -1):
+                output_sink.mark(path, card_start)
+        if (is_accepted(flashcard)):
             g_valid_num += 1
         output = []
         current_index += 1
@@ -1588,105 +2559,891 @@ def sort_flashcards_by_subject(flashcard_list, subject_set):
         
     return sorted_list
 
-def parse_files(args, question_count, err_count, parser, licence_theme, subject): 
-    # Copy all files in sourcedir
-    sourcedir = os.path.abspath(args.sourcedir)
+def parse_file(workpath, file, parser, licence_theme, subject, resource_index):
+    # XML Tree
+    with profile_stage('read'):
+        tree = resource_index.parse_quiz(workpath, parser)
+    root = tree.getroot()
+
+    # Create Flashcard instance
+    with profile_stage('fetch'):
+        flashcard = fetch_content(file, root, licence_theme, subject, resource_index)
+
+    with profile_stage('check'):
+        # Check overflow
+        check_overflow(flashcard)
+
+        # Check metadata
+        check_metadata(flashcard)
+
+        # Check non-pertinent content (URLs)
+        check_content(flashcard)
+
+    return flashcard
+
+# Parsing worker state, set once per process by init_parse_worker
+worker_state = {}
+
+def init_parse_worker(worker_args, licence_theme, subject, resource_index, texfilter, sizes):
+    global args, tex_filter, profiler, image_sizes
+    args = worker_args
+    tex_filter = texfilter
+    image_sizes = sizes
+    # Workers started without fork measure their files too
+    if (profiler is None and args.profile is not None):
+        profiler = Profiler()
+    worker_state['parser'] = etree.XMLParser(remove_blank_text=True, remove_comments=True)
+    worker_state['licence_theme'] = licence_theme
+    worker_state['subject'] = subject
+    worker_state['resource_index'] = resource_index
+
+def parse_file_worker(task):
+    # Returns the flashcard, the messages logged while parsing it and its timing with --profile
+    global log_buffer
+    (workpath, file) = task
+    previous_log_buffer = log_buffer
+    log_buffer = []
+    try:
+        if (profiler is None):
+            flashcard = parse_file(workpath, file, worker_state['parser'], worker_state['licence_theme'], worker_state['subject'], worker_state['resource_index'])
+            return (flashcard, log_buffer, None)
+        profiler.begin_file(file)
+        try:
+            flashcard = parse_file(workpath, file, worker_state['parser'], worker_state['licence_theme'], worker_state['subject'], worker_state['resource_index'])
+        finally:
+            timing = profiler.end_file()
+        return (flashcard, log_buffer, timing)
+    finally:
+        log_buffer = previous_log_buffer
+
+def record_parse_result(result):
+    # (flashcard, logs) of a parse_file_worker result, its timing goes to the profiler
+    (flashcard, logs, timing) = result
+    if (timing is not None):
+        profiler.add_file(timing)
+    return (flashcard, logs)
+
+def parse_files(args, question_count, err_count, parser, licence_theme, subject, resource_index): 
+    # Every .quiz file in sourcedir (File name option)
     subject_list = []
     flashcard_list = []
-    for (root_dir,dirs,files) in os.walk(sourcedir, topdown=True):
-        for file in files:
-            # Ignore all files which are not .quiz
-            if (file.endswith(".quiz") is False):
-                continue
-            # File name option
-            if (args.file_name is not None and file != args.file_name):
-                continue
+    tasks = []
+    for (workpath, file) in resource_index.quiz_files(args.file_name):
+        if (workpath is not None):
+            tasks.append((workpath, file))
+        else:
+            question_count += 1
 
-            workpath = os.path.join(os.path.relpath(root_dir), file)
-            if os.path.isfile(workpath):
-                # XML Tree
-                tree = etree.parse(workpath, parser)
-                root = tree.getroot()
-                
-                # Create Flashcard instance
-                flashcard = fetch_content(file, root, licence_theme, subject)
-                
-                # Check overflow
-                check_overflow(flashcard)
-                            
-                # Check metadata
-                check_metadata(flashcard)
-
-                # Check non-pertinent content (URLs)
-                check_content(flashcard)
-                
-                # Process filters, ignore flashcards not concerned
-                if (args.image_only is True and flashcard.image is None):
-                    continue
-                if (args.overflow_only is True and flashcard.overflow_flag is False):
-                    continue
-                if (args.non_relevant_only is True and flashcard.relevant is True):
-                    continue
+    # Debug mode prints while parsing, files are parsed and processed one at a time
+    if (args.debug_mode is True):
+        for (workpath, file) in tasks:
+            flashcard = parse_file(workpath, file, parser, licence_theme, subject, resource_index)
+            (question_count, err_count) = process_flashcard(flashcard, flashcard_list, subject_list, question_count, err_count)
+        return (flashcard_list, subject_list, question_count, err_count)
+
+    # Cached flashcards (and their logs) are reused, the other files are parsed
+    results = [None] * len(tasks)
+    keys = [None] * len(tasks)
+    if (flashcard_cache is not None):
+        with profile_stage('cache lookup'):
+            for (index, (workpath, file)) in enumerate(tasks):
+                keys[index] = flashcard_cache.key(resource_index.read_quiz(workpath), file)
+                results[index] = flashcard_cache.load(keys[index])
+                # Cached flashcards may reference resources which have not been extracted yet
+                if (results[index] is not None):
+                    locate_images(results[index][0], resource_index)
+    missing = [index for index in range(len(tasks)) if results[index] is None]
+    missing_tasks = [tasks[index] for index in missing]
+
+    # Image sizes are probed by a thread pool rather than one at a time by each parsed file
+    if (len(missing_tasks) > 1):
+        locations = resource_index.image_locations()
+        if (len(locations) > 0):
+            with profile_stage('image probe'):
+                image_sizes.prefetch(resource_index, locations, image_probe_threads)
+
+    # Parse every file, either serially or using a process pool
+    if (args.jobs > 1 and len(missing_tasks) > 1):
+        pool = multiprocessing.Pool(
+            processes = min(args.jobs, len(missing_tasks)),
+            initializer = init_parse_worker,
+            initargs = (args, licence_theme, subject, resource_index, tex_filter, image_sizes)
+        )
+        try:
+            parsed = pool.imap(parse_file_worker, missing_tasks, chunksize = max(1, len(missing_tasks) // (args.jobs * 4)))
+            for (index, result) in zip(missing, parsed):
+                results[index] = record_parse_result(result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        init_parse_worker(args, licence_theme, subject, resource_index, tex_filter, image_sizes)
+        for (index, task) in zip(missing, missing_tasks):
+            results[index] = record_parse_result(parse_file_worker(task))
+    if (flashcard_cache is not None):
+        for index in missing:
+            flashcard_cache.store(keys[index], results[index][0], results[index][1])
+    # Only a run parsing every file replaces the records of the source
+    if (flashcard_store is not None and args.file_name is None):
+        flashcard_store.save(resource_index.source_id(), results)
+
+    # Results (and their logs) are processed in the os.walk order in every case
+    for (index, (flashcard, logs)) in enumerate(results):
+        flashcard.cache_key = keys[index]
+        for (err_message, verb_err_message) in logs:
+            write_logs(err_message, verb_err_message)
+        (question_count, err_count) = process_flashcard(flashcard, flashcard_list, subject_list, question_count, err_count)
 
-                # Append to subject list
-                subject_list.append(flashcard.subject)
-                
-                # If --force option has been declared, put in dummy text to avoid compilation errors
-                if (args.force == True):
-                    if (flashcard.complexity_level is None and args.add_complexity_level is True):
-                        flashcard.complexity_level = "Missing Complexity Level"
-                    if (flashcard.licence_theme is None):
-                        flashcard.licence_theme = "Missing Licence Theme"
-                    if (flashcard.subject is None):
-                        flashcard.subject = "Missing Subject"        
-                
-                # Error procedure
-                if (flashcard.err_flag is True or flashcard.overflow_flag is True or flashcard.relevant is False):
-                    err_count += 1
-                    process_error(flashcard) 
-                
-                # If a flashcard has been forcibly output, and its error message is not null
-                elif (args.force == True and flashcard.err_message != ''):
-                    err_count += 1
-                    process_error(flashcard)
+    return (flashcard_list, subject_list, question_count, err_count)
 
-                # Make a list of every flashcard in sourcedir
-                flashcard_list.append(flashcard)
-            
-            question_count += 1
+def load_stored_files(args, question_count, err_count, source, resource_index):
+    # Same as parse_files, with the flashcards recorded in the store (--from_store)
+    # resource_index : None for a source directory, the index of an archive to extract the resources from
+    subject_list = []
+    flashcard_list = []
+    results = flashcard_store.load(source, args.file_name, args.image_only, args.overflow_only, args.non_relevant_only)
+    if (results is None):
+        raise ConversionError('Error store: no flashcards of ' + source + ' parsed with these options (themes, --add_url, --no_replace, --add_complexity_level, --force, --verbose) in ' + args.store + '. Run once without --from_store.')
+    if (args.file_name is not None and len(results) == 0):
+        raise ConversionError('Error: ' + args.file_name +' is not a file or does not exist.')
+    for (flashcard, logs) in results:
+        if (resource_index is not None):
+            locate_images(flashcard, resource_index)
+        for (err_message, verb_err_message) in logs:
+            write_logs(err_message, verb_err_message)
+        (question_count, err_count) = process_flashcard(flashcard, flashcard_list, subject_list, question_count, err_count)
 
     return (flashcard_list, subject_list, question_count, err_count)
 
-def compile_tex(args):
-    if (os.path.basename(os.getcwd()) != 'output'):
-        os.chdir(get_output_directory())
-        # write_logs(
-        #     "Current working directory is not the output directory. Please change directory.",
-        #     "Current working directory is not the output directory. Please change directory."
-        # )
+def process_flashcard(flashcard, flashcard_list, subject_list, question_count, err_count):
+    # Process filters, ignore flashcards not concerned
+    if (args.image_only is True and flashcard.image is None):
+        return (question_count, err_count)
+    if (args.overflow_only is True and flashcard.overflow_flag is False):
+        return (question_count, err_count)
+    if (args.non_relevant_only is True and flashcard.relevant is True):
+        return (question_count, err_count)
+
+    # Append to subject list
+    subject_list.append(flashcard.subject)
+    
+    # If --force option has been declared, put in dummy text to avoid compilation errors
+    if (args.force == True):
+        if (flashcard.complexity_level is None and args.add_complexity_level is True):
+            flashcard.complexity_level = "Missing Complexity Level"
+        if (flashcard.licence_theme is None):
+            flashcard.licence_theme = "Missing Licence Theme"
+        if (flashcard.subject is None):
+            flashcard.subject = "Missing Subject"        
+    
+    # Error procedure
+    if (flashcard.err_flag is True or flashcard.overflow_flag is True or flashcard.relevant is False):
+        err_count += 1
+        process_error(flashcard) 
+    
+    # If a flashcard has been forcibly output, and its error message is not null
+    elif (args.force == True and flashcard.err_message != ''):
+        err_count += 1
+        process_error(flashcard)
+
+    # Make a list of every flashcard in sourcedir
+    flashcard_list.append(flashcard)
+    question_count += 1
+
+    return (question_count, err_count)
+
+# Near-duplicate detection (--duplicates) : MinHash signatures of the word 3-grams of each flashcard,
+# cut in bands of minhash_rows values for the LSH index, so that only the flashcards sharing a band are compared
+minhash_size = 64
+minhash_rows = 4
+
+def duplicate_shingles(flashcard):
+    # Normalised words of the question and choices (no accents, case, TeX commands nor punctuation),
+    # in 3-grams, and the solution list
+    text = unicodedata.normalize('NFKD', ' '.join([flashcard.question] + list(flashcard.choices)).lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    words = re.findall(r'[a-z0-9]+', re.sub(r'\\[a-z]+', ' ', text))
+    shingles = set(' '.join(words[i:i + 3]) for i in range(max(1, len(words) - 2)))
+    shingles.add('solution ' + ' '.join(str(solution) for solution in flashcard.solution_list))
+    return shingles
+
+def minhash_signature(shingles):
+    # One permutation hashing : each shingle is hashed once, into one of minhash_size bins which keep their minimum
+    # (empty bins keep 1 << 64, see find_duplicates)
+    signature = [1 << 64] * minhash_size
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size = 8).digest(), 'little')
+        (position, value) = (value % minhash_size, value // minhash_size)
+        if (value < signature[position]):
+            signature[position] = value
+    return signature
+
+def jaccard(first, second):
+    return len(first & second) / len(first | second)
+
+def find_duplicates(flashcard_list, threshold):
+    # Clusters of near-duplicate flashcards, as lists of indexes in flashcard_list (in order)
+    # Each flashcard is compared to the previous flashcards of every LSH bucket it falls in
+    # (not already in its cluster), and joins the cluster of each one over the threshold :
+    # the buckets of distinct flashcards are small, and so is the number of comparisons
+    shingles = [duplicate_shingles(flashcard) for flashcard in flashcard_list]
+    parent = list(range(len(flashcard_list)))
+    def find(index):
+        while (parent[index] != index):
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    buckets = {}
+    for (index, card_shingles) in enumerate(shingles):
+        signature = minhash_signature(card_shingles)
+        for start in range(0, len(signature), minhash_rows):
+            band = tuple(signature[start:start + minhash_rows])
+            # A band of empty bins would put every short flashcard in one bucket
+            if (all(value == 1 << 64 for value in band)):
+                continue
+            bucket = buckets.setdefault((start, band), [])
+            for other in bucket:
+                if (find(other) != find(index) and jaccard(shingles[other], card_shingles) >= threshold):
+                    parent[find(index)] = find(other)
+            bucket.append(index)
+
+    clusters = {}
+    for index in range(len(flashcard_list)):
+        clusters.setdefault(find(index), []).append(index)
+    return ([cluster for cluster in clusters.values() if len(cluster) > 1], shingles)
+
+def process_duplicates(flashcard_list, subject_list, question_count, err_count, mode, threshold, report_path):
+    # Keeps the first flashcard of each cluster (the first accepted one if any), and flags the others
+    # as errors (written to out-rejected.tex, even with --force, see is_accepted) or drops them.
+    # The clusters are written to report_path.
+    def is_rejected(flashcard):
+        return flashcard.err_flag is True or flashcard.overflow_flag is True or flashcard.relevant is False or (args.force == True and flashcard.err_message != '')
+    (clusters, shingles) = find_duplicates(flashcard_list, threshold)
+    report = {'mode' : mode, 'threshold' : threshold, 'clusters' : []}
+    dropped = set()
+    for cluster in clusters:
+        kept = next((index for index in cluster if not is_rejected(flashcard_list[index])), cluster[0])
+        duplicates = []
+        for index in cluster:
+            if (index == kept):
+                continue
+            flashcard = flashcard_list[index]
+            similarity = jaccard(shingles[kept], shingles[index])
+            duplicates.append({'file' : flashcard.file, 'similarity' : round(similarity, 3)})
+            if (mode == 'drop'):
+                dropped.add(index)
+                question_count -= 1
+                if (is_rejected(flashcard)):
+                    err_count -= 1
+            else:
+                if (not is_rejected(flashcard)):
+                    err_count += 1
+                message = 'opale2flashcard.py(' + flashcard.file + "): Near-duplicate of " + flashcard_list[kept].file + " ({0:.2f} similar).".format(similarity)
+                flashcard.err_flag = True
+                flashcard.duplicate_of = flashcard_list[kept].file
+                flashcard.err_message += message
+                write_logs(message, message)
+        report['clusters'].append({'kept' : flashcard_list[kept].file, 'duplicates' : duplicates})
+
+    with open(report_path, 'w', encoding = 'utf-8') as report_file:
+        json.dump(report, report_file, indent = 1)
+    write_logs(
+        'opale2flashcard.py: ' + str(sum(len(cluster) - 1 for cluster in clusters)) + ' near-duplicate flashcards ' + ('dropped' if mode == 'drop' else 'flagged') + ', see ' + os.path.basename(report_path) + '.',
+        'opale2flashcard.py: ' + str(sum(len(cluster) - 1 for cluster in clusters)) + ' near-duplicate flashcards in ' + str(len(clusters)) + ' clusters ' + ('dropped' if mode == 'drop' else 'flagged') + ', see ' + report_path + '.'
+    )
+    if (len(dropped) > 0):
+        flashcard_list[:] = [flashcard for (index, flashcard) in enumerate(flashcard_list) if index not in dropped]
+        subject_list[:] = [subject for (index, subject) in enumerate(subject_list) if index not in dropped]
+    return (question_count, err_count)
+
+def copy_file(source, destination):
+    # Hard link to a file, or a copy across file systems : unlike a symbolic link,
+    # it stays valid when the source is evicted from a cache or removed
+    if (os.path.lexists(destination)):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+def link_file(source, destination):
+    # Symbolic link to a cached file, or a copy where links are not supported
+    if (os.path.lexists(destination)):
+        os.remove(destination)
+    try:
+        os.symlink(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+# Image slot of a question on a 10 x 8 cm card in inches : 0.35 of the line width by 0.4 of the card height (see write_image)
+image_slot = (0.35 * 10 / 2.54, 0.4 * 8 / 2.54)
+
+def resample_image(task):
+    # Runs in a resampling process : fits the image in box (pixels), in PNG for a .gif
+    # A resampled image is saved at dpi, so that its natural size fits the image slot
+    # Returns None, or the error message
+    (source, destination, box, dpi, image_format) = task
+    try:
+        with Image.open(source) as image:
+            size = image.size
+            if (image_format == 'PNG' and image.mode not in ('RGB', 'RGBA', 'L', 'LA')):
+                image = image.convert('RGBA')
+            elif (image_format == 'JPEG' and image.mode not in ('RGB', 'L')):
+                image = image.convert('RGB')
+            image.thumbnail(box, Image.LANCZOS)
+            if (image.size != size):
+                image.save(destination, image_format, dpi = (dpi, dpi))
+            else:
+                image.save(destination, image_format)
+    except Exception as error:
+        return str(error)
+    return None
+
+def store_images(flashcard_list, store_dir, image_cache, dpi, dedup, jobs):
+    # Content-addressed store of the question images : every image is copied (hard linked) in store_dir under the hash
+    # of its content, so that an image referenced by several quizzes (under different paths) is read
+    # and embedded once by xelatex.
+    # With dpi, the images larger than the image slot (and every .gif image) are replaced
+    # by a resampled copy, so that xelatex reads and embeds small files.
+    # Copies are cached under the hash of the image and the target size.
+    # Without dedup, only the resampled copies are stored.
+    if (dpi is not None):
+        box = (round(image_slot[0] * dpi), round(image_slot[1] * dpi))
+    stored = {}
+    tasks = []
+    queued = set()
+    for flashcard in flashcard_list:
+        for path in flashcard.image or []:
+            if (path in stored):
+                continue
+            stored[path] = path
+            is_gif = path.lower().endswith('.gif')
+            resample = False
+            if (dpi is not None):
+                try:
+                    with Image.open(path) as image:
+                        size = image.size
+                    resample = is_gif is True or size[0] > box[0] or size[1] > box[1]
+                except Exception:
+                    # Included as it is, as without --image_dpi
+                    pass
+            if (resample is False):
+                if (dedup is True and is_gif is False and os.path.isfile(path)):
+                    stored[path] = (file_hash(path) + os.path.splitext(path)[1].lower(), path)
+                continue
+            if (is_gif is True or path.lower().endswith('.png')):
+                (extension, image_format) = ('.png', 'PNG')
+            else:
+                (extension, image_format) = ('.jpg', 'JPEG')
+            key = file_hash(path) + '-' + str(box[0]) + 'x' + str(box[1]) + extension
+            # Copies of a same image are resampled once
+            if (key not in queued and image_cache.touch(key) is False):
+                queued.add(key)
+                tasks.append((path, image_cache.path(key) + '.' + str(os.getpid()) + '.resampling.tmp', box, dpi, image_format))
+            stored[path] = (key, image_cache.path(key))
+
+    # Every missing copy is resampled, using a process pool with --jobs
+    if (jobs > 1 and len(tasks) > 1):
+        pool = multiprocessing.Pool(processes = min(jobs, len(tasks)))
+        try:
+            errors = pool.map(resample_image, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        errors = [resample_image(task) for task in tasks]
+    for ((path, tmp_path, box, dpi, image_format), error) in zip(tasks, errors):
+        if (error is None):
+            with open(tmp_path, 'rb') as image:
+                image_cache.put(stored[path][0], image.read())
+        else:
+            write_logs(
+                "opale2flashcard.py(" + os.path.basename(path) + "): could not be resampled, the image is included as it is.",
+                "opale2flashcard.py(" + path + "): could not be resampled (" + error + "), the image is included as it is."
+            )
+            stored[path] = path
+        if (os.path.isfile(tmp_path)):
+            os.remove(tmp_path)
+
+    # Paths sharing a content share their copy, the store belongs to the output directory
+    os.makedirs(store_dir, exist_ok = True)
+    linked = set()
+    for (path, entry) in stored.items():
+        if (entry == path):
+            continue
+        (key, source) = entry
+        stored[path] = os.path.join(store_dir, key)
+        if (key not in linked):
+            copy_file(source, stored[path])
+            linked.add(key)
+    # Flashcards share their image list with the cache entries, which keep the original paths
+    for flashcard in flashcard_list:
+        if (flashcard.image is None):
+            continue
+        image = []
+        for path in flashcard.image:
+            if (stored[path].lower().endswith('.gif')):
+                # A .gif which could not be converted is not supported by xelatex
+                write_logs(
+                    flashcard.file + ' > Found a .gif ressource/image. Not supported',
+                    flashcard.file + ' > Found a .gif ressource/image. Not supported'
+                )
+            else:
+                image.append(stored[path])
+        flashcard.image = image if len(image) > 0 else None
+
+def get_svg_converter():
+    # (name, command line builder) of the first SVG to PDF converter installed, None if there is none
+    if (shutil.which('rsvg-convert') is not None):
+        return ('rsvg-convert', lambda svg_path, pdf_path: ['rsvg-convert', '--format=pdf', '--output=' + pdf_path, svg_path])
+    if (shutil.which('inkscape') is not None):
+        result = subprocess.run(['inkscape', '--version'], stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, universal_newlines = True)
+        version = result.stdout.strip()
+        # Inkscape 0.92 and 1.x do not share the same command line
+        if (version.startswith('Inkscape 0.')):
+            return (version, lambda svg_path, pdf_path: ['inkscape', '--without-gui', '--export-pdf=' + pdf_path, svg_path])
+        return (version, lambda svg_path, pdf_path: ['inkscape', '--export-type=pdf', '--export-filename=' + pdf_path, svg_path])
+    if (shutil.which('cairosvg') is not None):
+        return ('cairosvg', lambda svg_path, pdf_path: ['cairosvg', '--format=pdf', '--output=' + pdf_path, svg_path])
+    return None
+
+def convert_artwork(subject_set, images_dir, artwork_dir, artwork_cache):
+    # Converts the SVG artwork of every subject (header, footer, background, icon, logo) to PDF,
+    # and links the PDFs in artwork_dir under the name of their SVG.
+    # Conversions are cached under the hash of the SVG and of the converter.
+    # Returns False if some artwork could not be converted : xelatex then converts the SVGs itself.
+    converter = get_svg_converter()
+    if (converter is None):
+        write_logs(
+            "opale2flashcard.py: no SVG converter found (rsvg-convert, inkscape, cairosvg), the artwork will be converted by xelatex.",
+            "opale2flashcard.py: no SVG converter found (rsvg-convert, inkscape, cairosvg), the artwork will be converted by xelatex. Compile with --shell-escape."
+        )
+        return False
+    (converter_name, converter_command) = converter
+    names = set()
+    for subject in subject_set:
+        names.update(background_artwork(subject))
+        names.add('icons/' + subject.lower())
+    for name in sorted(names):
+        svg_path = os.path.join(images_dir, name + '.svg')
+        # Artwork which is not an SVG is included directly
+        if (not os.path.isfile(svg_path)):
+            continue
+        key = hashlib.sha256((converter_name + '\n' + file_hash(svg_path)).encode('utf-8')).hexdigest() + '.pdf'
+        if (artwork_cache.get(key) is None):
+            tmp_path = artwork_cache.path(key) + '.' + str(os.getpid()) + '.conversion.tmp'
+            result = subprocess.run(converter_command(svg_path, tmp_path), stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+            if (result.returncode != 0 or not os.path.isfile(tmp_path)):
+                write_logs(
+                    "opale2flashcard.py(" + name + ".svg): could not be converted to PDF, the artwork will be converted by xelatex.",
+                    "opale2flashcard.py(" + svg_path + "): " + converter_name + " could not convert it to PDF, the artwork will be converted by xelatex. Compile with --shell-escape."
+                )
+                if (os.path.isfile(tmp_path)):
+                    os.remove(tmp_path)
+                return False
+            with open(tmp_path, 'rb') as pdf:
+                artwork_cache.put(key, pdf.read())
+            os.remove(tmp_path)
+        os.makedirs(os.path.dirname(os.path.join(artwork_dir, name)), exist_ok = True)
+        link_file(artwork_cache.path(key), os.path.join(artwork_dir, name + '.pdf'))
+    return True
+
+def get_xelatex_version():
+    # First line of 'xelatex --version', None if xelatex cannot be run
+    try:
+        result = subprocess.run(['xelatex', '--version'], stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, universal_newlines = True)
+    except OSError:
+        return None
+    if (result.returncode != 0 or result.stdout == ''):
+        return None
+    return result.stdout.splitlines()[0]
+
+def dump_preamble_format(preamble, format_cache, key, shell_escape):
+    # Dumps the preamble in format_cache under key with mylatexformat, in a temporary directory
+    # so that concurrent runs do not overwrite each other's files
+    build_dir = tempfile.mkdtemp(dir = format_cache.directory)
+    try:
+        with open(os.path.join(build_dir, 'preamble.tex'), 'w', encoding = 'utf-8') as preamble_file:
+            preamble_file.write(preamble + preamble_dump_marker + '\\begin{document}\n\\end{document}\n')
+        command = ['xelatex', '-ini', '--interaction=batchmode']
+        if (shell_escape is True):
+            command.append('--shell-escape')
+        subprocess.run(
+            command + ['-jobname=preamble', '&xelatex', 'mylatexformat.ltx', 'preamble.tex'],
+            cwd = build_dir, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL
+        )
+        if (not os.path.isfile(os.path.join(build_dir, 'preamble.fmt'))):
+            return False
+        with open(os.path.join(build_dir, 'preamble.fmt'), 'rb') as format_file:
+            format_cache.put(key, format_file.read())
+        return True
+    finally:
+        shutil.rmtree(build_dir, ignore_errors = True)
+
+def get_preamble_format(texfile, format_cache, shell_escape):
+    # Returns the name of the format to compile texfile with, None to compile it normally.
+    # Formats are named after the hash of the preamble and of the xelatex version, and built once in format_cache.
+    with open(texfile, 'r', encoding = 'utf-8') as tex:
+        text = tex.read()
+    if (preamble_dump_marker not in text):
+        return None
+    xelatex_version = get_xelatex_version()
+    if (xelatex_version is None):
+        return None
+    preamble = text[:text.index(preamble_dump_marker)]
+    key = hashlib.sha256((xelatex_version + '\n' + preamble).encode('utf-8')).hexdigest()
+    # A preamble which could not be dumped is not tried again
+    if (format_cache.touch(key + '.failed') is True):
+        return None
+    if (format_cache.touch(key + '.fmt') is False):
+        if (dump_preamble_format(preamble, format_cache, key + '.fmt', shell_escape) is False):
+            format_cache.put(key + '.failed', b'')
+            write_logs(
+                "opale2flashcard.py: the preamble could not be precompiled (is mylatexformat installed ?), compiling without format.",
+                "opale2flashcard.py: the preamble could not be precompiled (is mylatexformat installed ?), compiling without format. See " + format_cache.directory + "."
+            )
+            return None
+    # xelatex looks for the format next to the compiled file
+    link_file(format_cache.path(key + '.fmt'), os.path.join(os.path.dirname(os.path.abspath(texfile)), 'out-preamble.fmt'))
+    return 'out-preamble'
+
+def get_pdf_merge_command(pdf_files, output_file):
+    # Command line merging pdf_files in output_file with the first PDF tool installed, None if there is none
+    if (shutil.which('pdfunite') is not None):
+        return ['pdfunite'] + pdf_files + [output_file]
+    if (shutil.which('qpdf') is not None):
+        return ['qpdf', '--empty', '--pages'] + pdf_files + ['--', output_file]
+    return None
+
+def split_tex(text, boundaries, shard_count):
+    # Splits a document in shard_count documents with the same header and footer.
+    # boundaries are the offsets of every card (every page in a4paper mode), then of the footer.
+    # Each document starts with the background parameters in use at its first card.
+    header = text[:boundaries[0]]
+    footer = text[boundaries[-1]:]
+    unit_count = len(boundaries) - 1
+    shards = []
+    for shard in range(shard_count):
+        start = boundaries[shard * unit_count // shard_count]
+        end = boundaries[(shard + 1) * unit_count // shard_count]
+        background = ''
+        position = -1
+        if (not text.startswith('\\backgroundparam\n', start)):
+            position = text.rfind('\\backgroundparam\n', 0, start)
+        if (position != -1):
+            background = '\n'.join(text[position:].split('\n', 9)[:9]) + '\n'
+        shards.append(header + background + text[start:end] + footer)
+    return shards
+
+def compile_shards(output_dir, command, boundaries, jobs):
+    # Compiles out.tex split in several documents in parallel, and merges their PDFs in out.pdf
+    # Returns False if out.tex must be compiled in one piece
+    shard_count = min(jobs, len(boundaries) - 1)
+    names = ['out-shard-' + str(shard + 1) for shard in range(shard_count)]
+    merge_command = get_pdf_merge_command([name + '.pdf' for name in names], 'out.pdf')
+    if (merge_command is None):
+        write_logs(
+            "opale2flashcard.py: no PDF merge tool found (pdfunite, qpdf), out.tex is compiled in one piece.",
+            "opale2flashcard.py: no PDF merge tool found (pdfunite, qpdf), out.tex is compiled in one piece. Install poppler-utils or qpdf to use --compile-jobs."
+        )
+        return False
+    with open(os.path.join(output_dir, 'out.tex'), 'r', encoding = 'utf-8', newline = '') as tex:
+        text = tex.read()
+    for (name, shard) in zip(names, split_tex(text, boundaries, shard_count)):
+        with open(os.path.join(output_dir, name + '.tex'), 'w', encoding = 'utf-8', newline = '') as shard_file:
+            shard_file.write(shard)
+        if (os.path.isfile(os.path.join(output_dir, name + '.pdf'))):
+            os.remove(os.path.join(output_dir, name + '.pdf'))
+
+    def compile_shard(name):
+        subprocess.run(command + [name + '.tex'], cwd = output_dir)
+        subprocess.run(command + [name + '.tex'], cwd = output_dir)
+        return os.path.isfile(os.path.join(output_dir, name + '.pdf'))
+
+    # xelatex runs in its own process, threads are enough to wait for them
+    with multiprocessing.pool.ThreadPool(shard_count) as pool:
+        compiled = pool.map(compile_shard, names)
+    if (os.path.isfile(os.path.join(output_dir, 'out.pdf'))):
+        os.remove(os.path.join(output_dir, 'out.pdf'))
+    # out.tex is compiled in one piece if a shard or the merge failed, its log then locates the error
+    for (name, shard_compiled) in zip(names, compiled):
+        if (shard_compiled is False):
+            write_logs(
+                "opale2flashcard.py: " + name + ".tex could not be compiled, out.tex is compiled in one piece.",
+                "opale2flashcard.py: " + name + ".tex could not be compiled, out.tex is compiled in one piece. Please refer to " + name + ".log."
+            )
+            return False
+    result = subprocess.run(merge_command, cwd = output_dir)
+    if (result.returncode != 0 or not os.path.isfile(os.path.join(output_dir, 'out.pdf'))):
+        write_logs(
+            "opale2flashcard.py: the PDFs of out.tex could not be merged, out.tex is compiled in one piece.",
+            "opale2flashcard.py: " + merge_command[0] + " could not merge the PDFs of out.tex (exit status " + str(result.returncode) + "), out.tex is compiled in one piece."
+        )
+        if (os.path.isfile(os.path.join(output_dir, 'out.pdf'))):
+            os.remove(os.path.join(output_dir, 'out.pdf'))
+        return False
+    return True
+
+def get_images_fingerprint(images_dir):
+    # Hash of every image (icons, artwork, qrcode), changed when one of them is updated
+    sha = hashlib.sha256()
+    for (root_dir, dirs, files) in os.walk(images_dir, followlinks = True):
+        dirs.sort()
+        for file in sorted(files):
+            sha.update((os.path.relpath(os.path.join(root_dir, file), images_dir) + ' ' + file_hash(os.path.join(root_dir, file)) + '\n').encode('utf-8'))
+    return sha.hexdigest()
+
+# Images of a flashcard, included with their absolute path
+includegraphics_regex = re.compile(r'\\includegraphics(?:\[[^\]]*\])?\{([^}]*)\}')
+# Name of an image of the store (see store_images)
+stored_image_regex = re.compile(r'[0-9a-f]{64}(-[0-9]+x[0-9]+)?\.[a-z]+$')
+
+def compile_cards(output_dir, command, marks, card_cache, images_dir, jobs):
+    # Compiles every card (every page in a4paper mode) of out.tex and out-<subject>.tex in its own document,
+    # and assembles out.pdf and out-<subject>.pdf from the PDFs of the cards.
+    # The PDF of a card is cached under the hash of its document (header, background parameters, card),
+    # of the compilation command and of the images, so that only new or changed cards are compiled.
+    # Returns False if out.tex must be compiled in one piece
+    if (get_pdf_merge_command([], 'out.pdf') is None):
+        write_logs(
+            "opale2flashcard.py: no PDF merge tool found (pdfunite, qpdf), out.tex is compiled in one piece.",
+            "opale2flashcard.py: no PDF merge tool found (pdfunite, qpdf), out.tex is compiled in one piece. Install poppler-utils or qpdf to use --compile_cards."
+        )
+        return False
+    fingerprint = ' '.join(command) + '\n' + str(get_xelatex_version()) + '\n' + get_images_fingerprint(images_dir) + '\n'
+    documents = {}
+    outputs = []
+    image_hashes = {}
+    for path in sorted(marks):
+        if (path.endswith('-rejected.tex') or len(marks[path]) < 2):
+            continue
+        with open(path, 'r', encoding = 'utf-8', newline = '') as tex:
+            text = tex.read()
+        keys = []
+        for document in split_tex(text, marks[path], len(marks[path]) - 1):
+            sha = hashlib.sha256((fingerprint + document).encode('utf-8'))
+            for image_path in includegraphics_regex.findall(document):
+                # Images of the output directory are included with a relative path (see get_image_path)
+                image_path = os.path.normpath(os.path.join(output_dir, image_path))
+                if (os.path.isfile(image_path)):
+                    if (image_path not in image_hashes):
+                        # Images of the store are named after their content (see store_images)
+                        if (os.path.basename(os.path.dirname(image_path)) == 'image-store' and stored_image_regex.match(os.path.basename(image_path))):
+                            image_hashes[image_path] = os.path.basename(image_path)
+                        else:
+                            image_hashes[image_path] = file_hash(image_path)
+                    sha.update(image_hashes[image_path].encode('utf-8'))
+            key = sha.hexdigest() + '.pdf'
+            documents[key] = document
+            keys.append(key)
+        outputs.append((os.path.basename(path)[:-len('.tex')] + '.pdf', keys))
+
+    def compile_card(key):
+        # Compiled next to out.tex, for the relative image paths and the preamble format
+        name = 'out-card-' + key[:16]
+        with open(os.path.join(output_dir, name + '.tex'), 'w', encoding = 'utf-8', newline = '') as card_file:
+            card_file.write(documents[key])
+        subprocess.run(command + [name + '.tex'], cwd = output_dir)
+        subprocess.run(command + [name + '.tex'], cwd = output_dir)
+        if (not os.path.isfile(os.path.join(output_dir, name + '.pdf'))):
+            # The document and its log are kept to find the error
+            return name
+        with open(os.path.join(output_dir, name + '.pdf'), 'rb') as pdf:
+            card_cache.put(key, pdf.read())
+        for filename in glob.glob(os.path.join(output_dir, name + '.*')):
+            os.remove(filename)
+        return None
+
+    # Cards shared by out.tex and out-<subject>.tex are compiled once
+    misses = [key for key in sorted(documents) if card_cache.touch(key) is False]
+    with multiprocessing.pool.ThreadPool(max(1, min(jobs, len(misses)))) as pool:
+        failed = [name for name in pool.map(compile_card, misses) if name is not None]
+    for name in failed:
+        write_logs(
+            "opale2flashcard.py: " + name + ".tex could not be compiled, the PDFs including it have not been created.",
+            "opale2flashcard.py: " + name + ".tex could not be compiled, the PDFs including it have not been created. Please refer to " + name + ".log."
+        )
+    # The cards of the run are kept by card_cache until the merge (see DiskCache)
+    merged = True
+    for (pdf_name, keys) in outputs:
+        if (os.path.isfile(os.path.join(output_dir, pdf_name))):
+            os.remove(os.path.join(output_dir, pdf_name))
+        if (all(os.path.isfile(card_cache.path(key)) for key in keys)):
+            result = subprocess.run(get_pdf_merge_command([card_cache.path(key) for key in keys], pdf_name), cwd = output_dir)
+            if (result.returncode == 0 and os.path.isfile(os.path.join(output_dir, pdf_name))):
+                continue
+        if (pdf_name == 'out.pdf'):
+            merged = False
+            write_logs(
+                "opale2flashcard.py: out.pdf could not be assembled from the cards, out.tex is compiled in one piece.",
+                "opale2flashcard.py: out.pdf could not be assembled from the cards (missing card PDF or merge error), out.tex is compiled in one piece."
+            )
+        elif (len(failed) == 0):
+            write_logs(
+                "opale2flashcard.py: " + pdf_name + " could not be assembled from the cards.",
+                "opale2flashcard.py: " + pdf_name + " could not be assembled from the cards (missing card PDF or merge error)."
+            )
+    return merged
+
+def compile_tex(args, shell_escape = True, marks = None, output_dir = None):
     if (args.compile == True):
-        os.system("xelatex --synctex=1 --interaction=batchmode --file-line-error --shell-escape out.tex")
-        os.system("xelatex --synctex=1 --interaction=batchmode --file-line-error --shell-escape out.tex")
-        
+        if (output_dir is None):
+            output_dir = get_output_directory()
+        # --shell-escape lets the svg package call inkscape, unless the artwork has been converted
+        command = ['xelatex', '--synctex=1', '--interaction=batchmode', '--file-line-error']
+        if (shell_escape is True):
+            command.append('--shell-escape')
+        if (args.precompile_preamble == True):
+            if (args.cache_dir is not None):
+                formats_dir = os.path.join(os.path.abspath(args.cache_dir), 'formats')
+            else:
+                formats_dir = os.path.join(get_headers_directory(), 'output', 'formats')
+            with profile_stage('preamble format'):
+                format_name = get_preamble_format(os.path.join(output_dir, 'out.tex'), DiskCache(formats_dir, get_cache_size('formats')), shell_escape)
+            if (format_name is not None):
+                command.append('-fmt=' + format_name)
+        if (marks is None):
+            marks = {}
+        boundaries = marks.get(os.path.join(output_dir, 'out.tex'), None)
+        if (args.compile_cards == True and boundaries is not None and len(boundaries) > 1):
+            if (args.cache_dir is not None):
+                card_cache_dir = os.path.join(args.cache_dir, 'cards')
+            else:
+                card_cache_dir = os.path.join(get_headers_directory(), 'output', 'card-cache')
+            card_cache = DiskCache(card_cache_dir, get_cache_size('cards'))
+            with profile_stage('xelatex cards'):
+                if (compile_cards(output_dir, command, marks, card_cache, get_images_directory(), args.compile_jobs) is True):
+                    return
+        # Several cards (or pages) are needed to split out.tex
+        if (args.compile_jobs > 1 and boundaries is not None and len(boundaries) > 2):
+            with profile_stage('xelatex shards'):
+                if (compile_shards(output_dir, command, boundaries, args.compile_jobs) is True):
+                    return
+        with profile_stage('xelatex pass 1'):
+            subprocess.run(command + ['out.tex'], cwd = output_dir)
+        with profile_stage('xelatex pass 2'):
+            subprocess.run(command + ['out.tex'], cwd = output_dir)
+        if (not os.path.isfile(os.path.join(output_dir, 'out.pdf'))):
+            write_logs(
+                "opale2flashcard.py: out.tex could not be compiled, out.pdf has not been created.",
+                "opale2flashcard.py: out.tex could not be compiled, out.pdf has not been created. Please refer to " + os.path.join(output_dir, 'out.log') + "."
+            )
 
 def clean_tex(args):
         
     for filename in glob.glob(os.path.join(get_output_directory(), "out*")):
         os.remove(filename)
+    # Resources extracted from a .scar archive, links to the converted artwork
+    shutil.rmtree(os.path.join(get_output_directory(), 'resources'), ignore_errors = True)
+    shutil.rmtree(os.path.join(get_output_directory(), 'artwork'), ignore_errors = True)
+    shutil.rmtree(os.path.join(get_output_directory(), 'image-store'), ignore_errors = True)
+
+# Themes parsed by previous conversions of the process, by themes file hash
+parsed_themes = {}
+
+class ConversionError(Exception):
+    # Invalid source, themes or options. The command line reports it on stderr and exits.
+    pass
+
+class Result:
+    # Outcome of a conversion : the TeX files written (name -> content), the flashcards
+    # accepted and rejected by subject, and the messages logged (by convert() only)
+    def __init__(self, output_dir, tex, accepted, rejected, question_count, err_count):
+        self.output_dir = output_dir
+        self.tex = tex
+        self.accepted = accepted
+        self.rejected = rejected
+        self.question_count = question_count
+        self.err_count = err_count
+        self.logs = []
+        # --profile report (see Profiler.report) and the path it has been written to
+        self.profile = None
+        self.profile_path = None
+
+def render_format(flashcard_list, subject_set, customqr_valid):
+    # Writes the out*.tex files of the current format (args.a4paper) from the parsed flashcards
+    # Returns the flashcards accepted and rejected, whether the artwork has been converted,
+    # the split points of out*.tex and their paths
+    global output_sink, g_valid_num
+    g_valid_num = 1
+    # Every out*.tex file (and logs.txt) is written through one buffered handle, flushed once at the end
+    output_sink = OutputSink(get_output_directory())
+    try:
+        # SVG artwork converted to PDF before writing the headers which include it
+        artwork_converted = False
+        if (args.convert_svg is True):
+            if (args.cache_dir is not None):
+                artwork_cache_dir = os.path.join(args.cache_dir, 'artwork')
+            else:
+                artwork_cache_dir = os.path.join(get_headers_directory(), 'output', 'artwork-cache')
+            artwork_cache = DiskCache(artwork_cache_dir, get_cache_size('artwork'))
+            with profile_stage('artwork'):
+                artwork_converted = convert_artwork(set(subject_set), get_images_directory(), os.path.join(get_output_directory(), 'artwork'), artwork_cache)
 
-def opale_to_tex(args):
+        write_outfile_header(set(subject_set), customqr_valid, artwork_converted)
+        
+        (accepted, rejected) = write_flashcards(flashcard_list, customqr_valid)
+        
+        write_outfile_footer(set(subject_set))
+
+        # Where out*.tex can be split for --compile-jobs and --compile_cards
+        marks = output_sink.marks
+        tex_paths = sorted(path for path in output_sink.files if path.endswith('.tex'))
+    finally:
+        output_sink.close()
+        output_sink = None
+    return (accepted, rejected, artwork_converted, marks, tex_paths)
+
+def run_conversion(args):
+    global tex_filter, flashcard_cache, flashcard_store, output_sink, output_format, g_valid_num, profiler, image_sizes
+    run_start = (time.perf_counter(), time.process_time())
+    source_is_bytes = isinstance(args.sourcedir, bytes)
     # Path validity check
-    if (not os.path.isdir(args.sourcedir)):
-        sys.stderr.write('Error source directory: ' + args.sourcedir + ' is not a directory or does not exist.\n')
-        sys.exit(1)
-    if (not os.path.isfile(args.themefile)):
-        sys.stderr.write('Error themefile: ' + args.themefile +' is not a file or does not exist.\n')
-        sys.exit(1)
-    if (args.file_name is not None):
+    if (source_is_bytes is True):
+        if (not zipfile.is_zipfile(io.BytesIO(args.sourcedir))):
+            raise ConversionError('Error source directory: the given bytes are not a .scar archive.')
+    elif (not os.path.isdir(args.sourcedir) and not (os.path.isfile(args.sourcedir) and zipfile.is_zipfile(args.sourcedir))):
+        raise ConversionError('Error source directory: ' + args.sourcedir + ' is neither a directory nor a .scar archive, or does not exist.')
+    if (not isinstance(args.themefile, bytes) and not os.path.isfile(args.themefile)):
+        raise ConversionError('Error themefile: ' + args.themefile +' is not a file or does not exist.')
+    # Formats written by the run, None : the one given by --a4paper, in the output directory
+    formats = [None]
+    if (args.formats is not None):
+        formats = []
+        for name in args.formats.split(','):
+            name = name.strip()
+            if (name not in ('default', 'a4paper')):
+                raise ConversionError('Error formats: ' + name + ' is not a format, use default or a4paper.')
+            if (name not in formats):
+                formats.append(name)
+    if (args.from_store is True and args.store is None):
+        raise ConversionError('Error: --from_store needs the --store database.')
+    if (not 0 < args.duplicate_threshold <= 1):
+        raise ConversionError('Error duplicate_threshold: ' + str(args.duplicate_threshold) + ' is not between 0 and 1.')
+    if (args.image_dpi is not None and args.image_dpi <= 0):
+        raise ConversionError('Error image_dpi: ' + str(args.image_dpi) + ' is not a resolution.')
+    if (args.file_name is not None and source_is_bytes is False and os.path.isdir(args.sourcedir)):
         if (not os.path.isfile(os.path.realpath(args.sourcedir + "/" + args.file_name))):
-            sys.stderr.write('Error: ' + args.file_name +' is not a file or does not exist.\n')
-            sys.exit(1)
-            
+            raise ConversionError('Error: ' + args.file_name +' is not a file or does not exist.')
+    if (args.texfilter_table is not None):
+        try:
+            tex_filter = TexFilter(load_texfilter_table(args.texfilter_table))
+        except (OSError, ValueError) as error:
+            raise ConversionError('Error texfilter table: ' + args.texfilter_table + ' ' + str(error))
+    else:
+        tex_filter = TexFilter(texfilter_table)
+    # Module state left by a previous conversion
+    flashcard_cache = None
+    flashcard_store = None
+    output_format = None
+    g_valid_num = 1
+    profiler = Profiler() if args.profile is not None else None
+
+    # An --output_dir is a self-contained workspace, concurrent runs do not share any written file
+    if (args.output_dir is not None):
+        link_shared_images(get_images_directory())
+
     customqr_valid = False
     if (args.add_qrcode is not None):
         if (re.match(url_regex, args.add_qrcode)):
@@ -1698,7 +3455,7 @@ def opale_to_tex(args):
             )
             qr.add_data(args.add_qrcode)
             img = qr.make_image(fill_color="#4e3b7b", back_color="white")
-            img.save(os.path.join(get_output_directory(), 'images/custom_qrcode.png'))
+            img.save(os.path.join(get_images_directory(), 'custom_qrcode.png'))
             customqr_valid = True
     
     # Parser settings
@@ -1710,8 +3467,13 @@ def opale_to_tex(args):
     if (args.noclean is False):
         clean_tex(args)
     
-    # Comment this line if you want to use a hard-coded dictionary
-    (licence_theme, subject) = get_subject_and_themes(args.themefile, parser)
+    # Comment these lines if you want to use a hard-coded dictionary
+    # Themes are parsed once per process, resident workers reuse them (see flashcard_server.py)
+    with profile_stage('themes'):
+        themes_key = file_hash(args.themefile)
+        if (themes_key not in parsed_themes):
+            parsed_themes[themes_key] = get_subject_and_themes(args.themefile, parser)
+    (licence_theme, subject) = parsed_themes[themes_key]
     # Example hard-coded dictionary
     # licence_theme = {
     #     'strucmat': 'Structure de la matière',
@@ -1725,23 +3487,310 @@ def opale_to_tex(args):
     # Variables
     (question_count, err_count) = (0,0)
     
-    (flashcard_list, subject_list, question_count, err_count) = parse_files(args, question_count, err_count, parser, licence_theme, subject)
-    
+    # Resources (images) index, built once for every flashcard
+    # Resources of a .scar archive are extracted in output/resources when referenced
+    # Stored flashcards have the paths of their images : a source directory is not walked again
+    if (args.from_store is True and source_is_bytes is False and os.path.isdir(args.sourcedir)):
+        resource_index = None
+        store_source = os.path.abspath(args.sourcedir)
+    else:
+        with profile_stage('resource index'):
+            resource_index = open_resource_index(args.sourcedir, os.path.join(get_output_directory(), 'resources'))
+        store_source = resource_index.source_id()
+        if (args.from_store is False and args.file_name is not None and not resource_index.quiz_files(args.file_name)):
+            raise ConversionError('Error: ' + args.file_name +' is not a file or does not exist.')
+
+    # Flashcards cache
+    if (args.cache_dir is not None and args.debug_mode is False and args.from_store is False):
+        flashcard_cache = FlashcardCache(args.cache_dir, get_cache_size('flashcards'), args, customqr_valid, resource_index)
+
+    # Image sizes
+    if (args.cache_dir is not None):
+        image_sizes = ImageSizes(DiskCache(os.path.join(args.cache_dir, 'image-sizes'), get_cache_size('image-sizes')))
+    else:
+        image_sizes = ImageSizes()
+
+    # Parsed flashcards store
+    if (args.store is not None):
+        try:
+            flashcard_store = FlashcardStore(args.store, args)
+        except sqlite3.Error as error:
+            raise ConversionError('Error store: ' + args.store + ' ' + str(error))
+
+    # Parsing logs are written through the output sink, as the out*.tex files of every format
+    output_sink = OutputSink(get_output_directory())
+    try:
+        with profile_stage('parse'):
+            if (args.from_store is True):
+                (flashcard_list, subject_list, question_count, err_count) = load_stored_files(args, question_count, err_count, store_source, resource_index)
+            else:
+                (flashcard_list, subject_list, question_count, err_count) = parse_files(args, question_count, err_count, parser, licence_theme, subject, resource_index)
+    finally:
+        output_sink.close()
+        output_sink = None
+        if (flashcard_store is not None):
+            flashcard_store.close()
+            flashcard_store = None
+        
     if (len(flashcard_list) == 0):
-        sys.stderr.write('Error  : no flashcards in ' + args.sourcedir + '\n')
-        sys.exit(1)
+        raise ConversionError('Error  : no flashcards in ' + (args.sourcedir if source_is_bytes is False else 'the given archive'))
+
+    # Near-duplicate questions, before any work on their images
+    if (args.duplicates is not None):
+        with profile_stage('duplicates'):
+            (question_count, err_count) = process_duplicates(flashcard_list, subject_list, question_count, err_count, args.duplicates, args.duplicate_threshold, os.path.join(get_output_directory(), 'duplicates.json'))
+
+    # Question images stored by content and resampled to the print resolution, once for every format
+    if (args.image_dpi is not None or args.dedup_images is True):
+        if (args.cache_dir is not None):
+            image_cache_dir = os.path.join(args.cache_dir, 'images')
+        else:
+            image_cache_dir = os.path.join(get_headers_directory(), 'output', 'image-cache')
+        image_cache = DiskCache(image_cache_dir, get_cache_size('images'))
+        with profile_stage('image store'):
+            store_images(flashcard_list, os.path.join(get_output_directory(), 'image-store'), image_cache, args.image_dpi, args.dedup_images, args.jobs)
     sorted_list = sort_flashcards_by_subject(flashcard_list, set(subject_list))
-    
-    write_outfile_header(set(subject_list), customqr_valid)
-    
-    (accepted, rejected) = write_flashcards(sorted_list, customqr_valid)
-    
-    write_outfile_footer(set(subject_list))
+
+    # Every format is rendered from the same parsed flashcards, in its own subdirectory with --formats
+    compilations = []
+    tex_paths = []
+    a4paper = args.a4paper
+    try:
+        for name in formats:
+            if (name is not None):
+                output_format = name
+                args.a4paper = name == 'a4paper'
+                if (args.noclean is False):
+                    clean_tex(args)
+            with profile_stage('render ' + ('a4paper' if args.a4paper is True else 'default')):
+                (accepted, rejected, artwork_converted, marks, paths) = render_format(sorted_list, subject_list, customqr_valid)
+            compilations.append((get_output_directory(), not artwork_converted, marks))
+            tex_paths += paths
+    finally:
+        (output_format, args.a4paper) = (None, a4paper)
+    if (flashcard_cache is not None):
+        with profile_stage('cache flush'):
+            flashcard_cache.flush()
 
     # Check out.tex
 
-    # Compile out.tex if option --compile has been declared
-    compile_tex(args)
+    # Compile out.tex if option --compile has been declared, every format at the same time with --compile-jobs
+    def compile_format(compilation):
+        (output_dir, shell_escape, marks) = compilation
+        compile_tex(args, shell_escape = shell_escape, marks = marks, output_dir = output_dir)
+    with profile_stage('compile'):
+        if (args.compile == True and args.compile_jobs > 1 and len(compilations) > 1):
+            with multiprocessing.pool.ThreadPool(len(compilations)) as pool:
+                pool.map(compile_format, compilations)
+        else:
+            for compilation in compilations:
+                compile_format(compilation)
+
+    tex = {}
+    for path in tex_paths:
+        with open(path, 'r', encoding = 'utf-8', newline = '') as tex_file:
+            tex[os.path.relpath(path, get_output_directory())] = tex_file.read()
+    result = Result(get_output_directory(), tex, accepted, rejected, question_count, err_count)
+
+    # Profiling report, written next to out.tex by default
+    if (profiler is not None):
+        result.profile = profiler.report()
+        result.profile['total'] = {'wall' : time.perf_counter() - run_start[0], 'cpu' : time.process_time() - run_start[1]}
+        if (args.profile != ''):
+            report_path = args.profile
+        else:
+            report_path = os.path.join(get_output_directory(), 'profile.json')
+        with open(report_path, 'w', encoding = 'utf-8') as report_file:
+            json.dump(result.profile, report_file, indent = 1)
+        result.profile_path = report_path
+    return result
+
+# Metadata read by --inventory, before the question of a .quiz file
+metadata_tags = {
+    literal_QName('sp', 'themeLicence') : 'theme_code',
+    literal_QName('sp', 'level') : 'level',
+    literal_QName('sp', 'educationLevel') : 'education_level',
+}
+question_tag = literal_QName('sc', 'question')
+
+def fetch_metadata(quiz):
+    # Question type and metadata texts of a .quiz file (as fetch_content finds them),
+    # parsed incrementally until the end of the element holding the metadata, or the question
+    metadata = {'question_type' : None, 'theme_code' : None, 'level' : None, 'education_level' : None}
+    metadata_parent = None
+    depth = 0
+    for (event, element) in etree.iterparse(quiz, events = ('start', 'end'), remove_comments = True):
+        if (event == 'start'):
+            depth += 1
+            if (depth == 2 and metadata['question_type'] is None):
+                metadata['question_type'] = etree.QName(element).localname
+            if (element.tag == question_tag):
+                break
+            continue
+        depth -= 1
+        name = metadata_tags.get(element.tag, None)
+        if (name is not None):
+            # Several elements are concatenated, as fetch_data does
+            metadata[name] = (metadata[name] or '') + (element.text or '')
+            if (metadata_parent is None):
+                metadata_parent = element.getparent()
+        elif (element is metadata_parent):
+            break
+    for name in ('theme_code', 'level', 'education_level'):
+        if (metadata[name] == ''):
+            metadata[name] = None
+    return metadata
+
+def run_inventory(args):
+    # Counts of the .quiz files of the source (--inventory), without parsing their content
+    if (not isinstance(args.sourcedir, bytes) and not os.path.isdir(args.sourcedir) and not (os.path.isfile(args.sourcedir) and zipfile.is_zipfile(args.sourcedir))):
+        raise ConversionError('Error source directory: ' + args.sourcedir + ' is neither a directory nor a .scar archive, or does not exist.')
+    if (not isinstance(args.themefile, bytes) and not os.path.isfile(args.themefile)):
+        raise ConversionError('Error themefile: ' + args.themefile +' is not a file or does not exist.')
+    themes_key = file_hash(args.themefile)
+    if (themes_key not in parsed_themes):
+        parsed_themes[themes_key] = get_subject_and_themes(args.themefile, etree.XMLParser(remove_blank_text=True, remove_comments=True))
+    (licence_theme_dict, subject_dict) = parsed_themes[themes_key]
+
+    # Nothing is extracted from an archive
+    resource_index = open_resource_index(args.sourcedir, os.path.join(get_output_directory(), 'resources'))
+    inventory = {
+        'files' : 0,
+        'question_type' : {},
+        'subject' : {},
+        'licence_theme' : {},
+        'complexity_level' : {},
+        'education_level' : {},
+        'missing' : {'licence_theme' : 0, 'complexity_level' : 0, 'education_level' : 0, 'unknown_theme_code' : 0},
+        'unreadable' : [],
+    }
+    def count(name, value):
+        inventory[name][value] = inventory[name].get(value, 0) + 1
+
+    for (workpath, file) in resource_index.quiz_files(args.file_name):
+        if (workpath is None):
+            continue
+        try:
+            with resource_index.open_quiz(workpath) as quiz:
+                metadata = fetch_metadata(quiz)
+        except etree.XMLSyntaxError as error:
+            inventory['unreadable'].append(file)
+            write_logs('opale2flashcard.py(' + file + '): ' + str(error))
+            continue
+        inventory['files'] += 1
+        (subject, licence_theme) = get_subject_and_licence_theme(file, metadata['theme_code'], licence_theme_dict, subject_dict)
+        complexity = get_complexity_level(metadata['level'])
+        count('question_type', metadata['question_type'])
+        if (licence_theme is None):
+            inventory['missing']['licence_theme'] += 1
+        else:
+            if (subject == '' or licence_theme == ''):
+                inventory['missing']['unknown_theme_code'] += 1
+            count('subject', subject)
+            count('licence_theme', subject + ' / ' + licence_theme)
+        if (complexity is None):
+            inventory['missing']['complexity_level'] += 1
+        else:
+            count('complexity_level', complexity)
+        if (metadata['education_level'] is None):
+            inventory['missing']['education_level'] += 1
+        else:
+            count('education_level', metadata['education_level'])
+    return inventory
+
+def print_inventory(inventory):
+    print('Inventory of ' + str(inventory['files']) + ' .quiz files')
+    for (name, title) in (('question_type', 'Question types'), ('subject', 'Subjects'), ('licence_theme', 'Licence themes'), ('complexity_level', 'Complexity levels'), ('education_level', 'Education levels')):
+        print('\n' + title + ':')
+        for (value, number) in sorted(inventory[name].items(), key = lambda item: (-item[1], item[0])):
+            print(value if value != '' else 'Non classifié', ':', number)
+    print('\nMissing metadata:')
+    print('Licence theme :', inventory['missing']['licence_theme'])
+    print('Unknown theme code :', inventory['missing']['unknown_theme_code'])
+    print('Complexity level :', inventory['missing']['complexity_level'])
+    print('Education level :', inventory['missing']['education_level'])
+    if (len(inventory['unreadable']) > 0):
+        print('\nUnreadable files :', ', '.join(inventory['unreadable']))
+
+# Held by convert for the whole conversion : the options, logs and caches of a run are module state
+conversion_lock = threading.Lock()
+
+def convert(source, themes, options = None):
+    # Library entry point, e.g. opale2flashcard.convert('quiz.scar', 'themeLicence.xml', {'a4paper' : True})
+    # source : .scar directory or archive path, or the bytes of a .scar archive
+    # themes : themes list file path, or its bytes
+    # options : command line options by name ('output_dir', 'a4paper', 'cache_dir'...), defaults otherwise
+    # Returns a Result, whose tex attribute holds the written TeX files and logs the messages.
+    # Raises ConversionError. Conversions share module state : concurrent calls (e.g. from the threads
+    # of an HTTP server) run one after the other, use processes to run them in parallel.
+    with conversion_lock:
+        return convert_locked(source, themes, options)
+
+def convert_locked(source, themes, options):
+    global args, log_buffer
+    run_args = parser.parse_args(['sourcedir', 'themefile'])
+    for (name, value) in (options or {}).items():
+        if (name in ('sourcedir', 'themefile') or not hasattr(run_args, name)):
+            raise ConversionError('Error: unknown option ' + name)
+        setattr(run_args, name, value)
+    run_args.sourcedir = source
+    run_args.themefile = themes
+    (previous_args, previous_log_buffer) = (args, log_buffer)
+    args = run_args
+    # Messages are returned instead of being printed
+    log_buffer = []
+    try:
+        result = run_conversion(run_args)
+        for (err_message, verb_err_message) in log_buffer:
+            if (args.verbose is True and verb_err_message is not None):
+                result.logs.append(verb_err_message)
+            elif (err_message is not None):
+                result.logs.append(err_message)
+    finally:
+        (args, log_buffer) = (previous_args, previous_log_buffer)
+    return result
+
+def print_profile(report, top):
+    # Stages in the order they ended, then the slowest files
+    print('\nProfile (wall / CPU / child processes CPU, in seconds):')
+    print('{0:<28} {1:>9} {2:>9} {3:>9} {4:>7}'.format('stage', 'wall', 'cpu', 'children', 'calls'))
+    for (name, timing) in report['stages'].items():
+        print('{0:<28} {1:>9.3f} {2:>9.3f} {3:>9.3f} {4:>7}'.format(name, timing['wall'], timing['cpu'], timing['children_cpu'], timing['calls']))
+    print('{0:<28} {1:>9.3f} {2:>9.3f}'.format('total', report['total']['wall'], report['total']['cpu']))
+    if (len(report['files']) > 0 and top > 0):
+        print('\nSlowest .quiz files (wall, in ms):')
+        for record in report['files'][:top]:
+            stages = ', '.join(name + ' ' + '{0:.1f}'.format(timing['wall'] * 1000) for (name, timing) in record['stages'].items())
+            print('{0:<28} {1:>9.1f}  {2}'.format(record['file'], record['wall'] * 1000, stages))
+
+def opale_to_tex(args):
+    if (args.inventory is not None):
+        try:
+            inventory = run_inventory(args)
+        except ConversionError as error:
+            sys.stderr.write(str(error) + '\n')
+            sys.exit(1)
+        print_inventory(inventory)
+        if (args.inventory != ''):
+            with open(args.inventory, 'w', encoding = 'utf-8') as inventory_file:
+                json.dump(inventory, inventory_file, ensure_ascii = False, indent = 1)
+        return
+
+    # The whole conversion (parent process) can be profiled with cProfile
+    if (args.cprofile is not None):
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+    try:
+        result = run_conversion(args)
+    except ConversionError as error:
+        sys.stderr.write(str(error) + '\n')
+        sys.exit(1)
+    finally:
+        if (args.cprofile is not None):
+            cprofiler.disable()
+            cprofiler.dump_stats(args.cprofile)
+    (accepted, rejected, question_count, err_count) = (result.accepted, result.rejected, result.question_count, result.err_count)
+
 
     # Termination message
     ## Check if --force has been declared
@@ -1776,12 +3825,19 @@ def opale_to_tex(args):
         print('WARNING : We replaced every occurence of "ci-dessous" in the question by "ci-contre". If it was a mistake, please modify as necessary.\n Use option "--no_replace" to deactivate this feature.')
     print('Please make use of the "--XXX-only" options to check every flashcard for potential defects')
 
+    if (result.profile is not None):
+        print_profile(result.profile, args.profile_top)
+        print('opale2flashcard.py: profiling report written in ' + result.profile_path)
+    if (args.cprofile is not None):
+        print('opale2flashcard.py: cProfile statistics written in ' + args.cprofile + ' (python3 -m pstats ' + args.cprofile + ')')
+
     if (args.compile == False):
         print("opale2flashcard.py: The .tex file out.tex has been created in ./output directory. Compiling it will produce a pdf file containing all flashcards in the specified source directory.\n Use option '--compile' if you want to compile directly after. You must have xelatex installed.")
     else:
         print("The .tex file has been compiled. The output pdf is in ./output directory. Please refer to output.log for eventual compilation errors.")
 
-start_time = time.time()
-args = parser.parse_args()
-opale_to_tex(args)
-print("The script took {0:0.3f} seconds to complete.".format(time.time() - start_time))
+if __name__ == '__main__':
+    start_time = time.time()
+    args = parser.parse_args()
+    opale_to_tex(args)
+    print("The script took {0:0.3f} seconds to complete.".format(time.time() - start_time))
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# encoding: utf-8
+# Micro-benchmark : single-pass texfilter vs the former chained str.replace version
+# Usage : python3 texfilter_benchmark.py [sourcedir] [--number N]
+import os
+import argparse
+import timeit
+from lxml import etree
+import opale2flashcard
+
+parser = argparse.ArgumentParser(description = "Compares texfilter with the former chained str.replace implementation on real quiz text.")
+parser.add_argument('sourcedir', nargs = '?', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Example-files'), help = """
+XML files' directory path - Defaults to the Example-files directory.
+""")
+parser.add_argument('--number', action = 'store', type = int, default = 200, help = """
+Number of passes over the quiz text.
+""")
+
+def legacy_texfilter(text):
+    # texfilter as it was before the single-pass TexFilter
+    if ('\\%' not in text):
+        text = text.replace('%','\\%')
+    if ('$^{-}$' not in text):
+        text = text.replace('ˉ', '$^{-}$')
+    text = text.replace('α', '$\\alpha$')
+    text = text.replace('Α', '$\\Alpha$')
+    text = text.replace('β', '$\\beta$')
+    text = text.replace('Β', '$\\Beta$')
+    text = text.replace('γ', '$\\gamma$')
+    text = text.replace('Γ', '$\\Gamma$')
+    text = text.replace('δ', '$\\delta$')
+    text = text.replace('Δ', '$\\Delta$')
+    text = text.replace('ε', '$\\epsilon$')
+    text = text.replace('Ε', '$\\Epsilon$')
+    text = text.replace('ζ', '$\\zeta$')
+    text = text.replace('Ζ', '$\\Zeta$')
+    text = text.replace('η', '$\\eta$')
+    text = text.replace('Η', '$\\Eta$')
+    text = text.replace('θ', '$\\theta$')
+    text = text.replace('Θ', '$\\Theta$')
+    text = text.replace('ι', '$\\iota$')
+    text = text.replace('Ι', '$\\Iota$')
+    text = text.replace('κ', '$\\kappa$')
+    text = text.replace('Κ', '$\\Kappa$')
+    text = text.replace('λ', '$\\lambda$')
+    text = text.replace('Λ', '$\\Lambda$')
+    text = text.replace('μ', '$\\mu$')
+    text = text.replace('Μ', '$\\Mu$')
+    text = text.replace('ν', '$\\nu$')
+    text = text.replace('Ν', '$\\Nu$')
+    text = text.replace('ξ', '$\\xi$')
+    text = text.replace('Ξ', '$\\Xi$')
+    text = text.replace('ο', 'o')
+    text = text.replace('Ο', 'O')
+    text = text.replace('π', '$\\pi$')
+    text = text.replace('Π', '$\\Pi$')
+    text = text.replace('ρ', '$\\rho$')
+    text = text.replace('Ρ', '$\\Rho$')
+    text = text.replace('σ', '$\\sigma$')
+    text = text.replace('Σ', '$\\Sigma$')
+    text = text.replace('τ', '$\\tau$')
+    text = text.replace('Τ', '$\\Tau$')
+    text = text.replace('υ', '$\\upsilon$')
+    text = text.replace('Υ', '$\\Upsilon$')
+    text = text.replace('φ', '$\\phi$')
+    text = text.replace('Φ', '$\\Phi$')
+    text = text.replace('χ', '$\\chi$')
+    text = text.replace('Χ', '$\\Chi$')
+    text = text.replace('ψ', '$\\psi$')
+    text = text.replace('Ψ', '$\\Psi$')
+    text = text.replace('ω', '$\\omega$')
+    text = text.replace('Ω', '$\\Omega$')
+    text = text.replace('→', '$\\longrightarrow$')
+    return text
+
+def quiz_fragments(sourcedir):
+    # Every text fragment of every quiz (what texfilter sees in mixed content),
+    # plus each quiz's full text (what texfilter sees for a whole answer)
+    xml_parser = etree.XMLParser(remove_blank_text=True, remove_comments=True)
+    fragments = []
+    for (root_dir, dirs, files) in os.walk(sourcedir):
+        for file in files:
+            if (file.endswith(".quiz") is False):
+                continue
+            root = etree.parse(os.path.join(root_dir, file), xml_parser).getroot()
+            texts = [text for text in root.itertext() if text.strip() != '']
+            fragments += texts
+            fragments.append(''.join(texts))
+    return fragments
+
+def main():
+    args = parser.parse_args()
+    fragments = quiz_fragments(args.sourcedir)
+    if (len(fragments) == 0):
+        print('texfilter_benchmark.py: no .quiz files in ' + args.sourcedir)
+        return
+
+    # Both implementations must agree before being compared
+    for fragment in fragments:
+        if (opale2flashcard.texfilter(fragment) != legacy_texfilter(fragment)):
+            print('texfilter_benchmark.py: outputs differ for ' + repr(fragment[:80]))
+            return
+
+    size = sum(len(fragment) for fragment in fragments)
+    print('{0} fragments, {1} characters, {2} passes'.format(len(fragments), size, args.number))
+    results = {}
+    for (name, function) in (('chained str.replace', legacy_texfilter), ('single-pass texfilter', opale2flashcard.texfilter)):
+        results[name] = min(timeit.repeat(lambda: [function(fragment) for fragment in fragments], number = args.number, repeat = 3))
+        print('{0:>22}: {1:0.4f} s ({2:0.2f} µs per fragment)'.format(name, results[name], results[name] * 1e6 / (args.number * len(fragments))))
+    print('Speed-up: {0:0.1f}x'.format(results['chained str.replace'] / results['single-pass texfilter']))
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,8 @@
 $path_to_script_folder = "/opt/cap_flashcards/";
 $path_to_theme_file = "/opt/cap_flashcards/Example-files/themeLicence.xml";
 $path_to_compile_script = "/opt/cap_flashcards/compile.sh";
+// Conversion service (Python/flashcard_server.py), e.g. "http://127.0.0.1:8765". Empty : convert within the request.
+$conversion_service = "";
 
 const FILES_EXTENSIONS = ['scar'];
 function error($text)
@@ -37,6 +39,60 @@ function printlogs($cmdout)
 	echo "</pre>";
 }
 
+// Sends a request to the conversion service, returns the decoded JSON answer
+function service_request($method, $url, $content = null)
+{
+	$options = array('http' => array('method' => $method, 'ignore_errors' => true));
+	if ($content !== null) {
+		$options['http']['header'] = "Content-Type: application/octet-stream\r\n";
+		$options['http']['content'] = $content;
+	}
+	$answer = @file_get_contents($url, false, stream_context_create($options));
+	if ($answer === false)
+		return null;
+	return json_decode($answer, true);
+}
+
+// Job sent to the conversion service : show its status until it is done
+if (!empty($conversion_service) && isset($_GET['job'])) {
+	$id = $_GET['job'];
+	if (!preg_match('/^[0-9a-f]{32}$/', $id))
+		error("Erreur interne : traitement inconnu.");
+	$job = service_request('GET', $conversion_service . '/jobs/' . $id);
+	if ($job === null || !isset($job['status']))
+		error("Erreur interne : le service de conversion ne répond pas, ou le traitement est inconnu.");
+
+	if ($job['status'] === 'queued' || $job['status'] === 'running') {
+		require_once("header.php");
+		echo '<meta http-equiv="refresh" content="5">';
+		echo ($job['status'] === 'queued' ? "Fichier accepté... En attente de traitement...</br>" : "Fichier accepté... Traitement en cours...</br>");
+		require_once("footer.php");
+		exit(0);
+	}
+	if ($job['status'] !== 'done') {
+		printlogs(array($job['error']));
+		error("<br><b>Erreur lors de la conversion !</b><br>");
+	}
+
+	$pathfinal = __DIR__ . '/upload/' . $id . '/';
+	if (!file_exists($pathfinal)) {
+		mkdir($pathfinal, 0700, true);
+	}
+	echo "<br><b>Conversion terminée !</b><br>";
+	printlogs($job['logs']);
+	if (file_exists($job['zip']) && !file_exists($pathfinal . 'latex.zip'))
+		copy($job['zip'], $pathfinal . 'latex.zip');
+	if (file_exists($pathfinal . 'latex.zip'))
+		echo "<p><a href=\"./upload/$id/latex.zip\">Téléchargez vos fichiers LaTeX et le fichier pdf</a></p>";
+	if ($job['pdf'] !== null && file_exists($job['pdf']) && !file_exists($pathfinal . 'out.pdf'))
+		copy($job['pdf'], $pathfinal . 'out.pdf');
+	if (file_exists($pathfinal . 'out.pdf')) {
+		echo "<h2>Prévisualisation</h2><p><br><iframe width=\"800\" height=\"900\" src=\"./upload/$id/out.pdf\"><a href=\"./upload/$id/out.pdf\">Lien de prévisualisation PDF</a></iframe></p>";
+	} else {
+		error("Erreur interne : la prévisualisation a échoué ");
+	}
+}
+
 if (!empty($_FILES)) {
 	$legalSize = 262144000;
 	$legalExtensions = array_map("strtolower", FILES_EXTENSIONS);
@@ -47,7 +103,6 @@ if (!empty($_FILES)) {
 	$extension = strtolower(pathinfo($_FILES['file']['name'], PATHINFO_EXTENSION));
 
 	$pathroot = '/tmp/upload/' . $id . '/';
-	$pathin = $pathroot . 'in/';
 	$pathfinal = __DIR__ . '/upload/' . $id . '/';
 	$filein = $pathroot . "scenari.scar";
 	$fileout = $pathroot . "latex.zip";
@@ -72,9 +127,6 @@ if (!empty($_FILES)) {
 	if (!file_exists($pathroot)) {
 		mkdir($pathroot, 0700, true);
 	}
-	if (!file_exists($pathin)); {
-		mkdir($pathin, 0700, true);
-	}
 	if (!file_exists($pathfinal)) {
 		mkdir($pathfinal, 0700, true);
 	}
@@ -84,19 +136,27 @@ if (!empty($_FILES)) {
 		error("Erreur interne : le fichier envoyé n'a pas pu être chargé correctement.");
 	}
 
-	// unzip the uploaded file
+	// check the uploaded file, the script reads the archive directly
 	$zip = new ZipArchive;
 	$res = $zip->open($filein);
 	if ($res === TRUE) {
-		$zip->extractTo($pathin);
 		$zip->close();
 	} else {
 		error("Erreur interne : le fichier envoyé n'a pas pu être dézippé.");
 	}
 
+	// The conversion service queues the job, its status page is polled
+	if (!empty($conversion_service)) {
+		$job = service_request('POST', $conversion_service . '/jobs?compile=1', file_get_contents($filein));
+		if ($job === null || !isset($job['id']))
+			error("Erreur interne : le service de conversion est occupé ou ne répond pas, réessayez plus tard.");
+		header('Location: ?job=' . $job['id']);
+		exit(0);
+	}
+
 	echo "Fichier accepté... Traitement en cours...</br>";
 	chdir($path_to_script_folder . "Python/");
-	exec("python3 opale2flashcard.py $pathin $path_to_theme_file --output " . $id . " 2>&1", $cmdout_python, $errcode);
+	exec("python3 opale2flashcard.py $filein $path_to_theme_file --output " . $id . " 2>&1", $cmdout_python, $errcode);
 	
 	if ($errcode === 0 && file_exists('output/' . $id . '/out.tex')) {
 		echo "<br><b>Conversion terminée !</b><br>";
@@ -22,19 +22,6 @@ if [ ! -d $OUTDIR ] ; then
 	exit
 fi
 
-TMPDIR=$(mktemp -d)
-UNZIPDIR="$TMPDIR/unzip"
-
-
-for scarfile in "$INDIR"/*.scar ; do
-	unzip $scarfile -d $UNZIPDIR
-	content=$(basename "$scarfile" .scar)
-	python3  ./Python/opale2flashcard.py $UNZIPDIR ./Example-files/themeLicence.xml --compile
-	mv ./Python/output/out.pdf "$OUTDIR/$content-print.pdf"
-	python3  ./Python/opale2flashcard.py $UNZIPDIR ./Example-files/themeLicence.xml --a4paper --compile
-	mv ./Python/output/out.pdf "$OUTDIR/$content-a4.pdf"
-	[[ "$UNZIPDIR" == /tmp/* ]] && rm -R "$UNZIPDIR"
-done
-
-[[ "$TMPDIR" == /tmp/* ]] && rm -R "$TMPDIR"
-
+# scar files are read directly by the script, no need to unzip them
+# Archives are converted in parallel, both formats from a single parse, see ./Python/compile_all.py --help
+python3 ./Python/compile_all.py "$INDIR" "$OUTDIR" ./Example-files/themeLicence.xml